@@ -6,25 +6,42 @@ Email:      ben.wirf@gmail.com
 ****************************************************************************************/
 """
 import os
+import re
+import json
+import math
+import time
+import hashlib
+import sqlite3
+import threading
+import queue
+import random
+import bisect
+import collections
+import concurrent.futures
+from array import array
 
-import processing
-
-from qgis.core import (QgsProject, QgsCoordinateTransform, QgsRectangle,
-QgsTextAnnotation, QgsFillSymbol, QgsGeometry, QgsTask, QgsRasterBlockFeedback,
-QgsRasterPipe, QgsRasterFileWriter, QgsRasterLayer, QgsApplication,
+from qgis.core import (QgsProject, QgsCoordinateTransform, QgsRectangle, QgsPointXY,
+QgsGeometry, QgsTask, QgsRasterBlockFeedback,
+QgsRasterPipe, QgsRasterInterface, QgsRasterBlock, QgsRasterLayer, QgsApplication,
 QgsMapLayerProxyModel, QgsWkbTypes, QgsMessageLog, QgsRasterProjector,
-QgsCoordinateReferenceSystem, Qgis)
+QgsCoordinateReferenceSystem, QgsCsException, QgsSettings, QgsProcessingProvider,
+QgsProcessingAlgorithm, QgsProcessingException, QgsProcessingParameterString,
+QgsProcessingParameterExtent, QgsProcessingParameterNumber, QgsProcessingParameterCrs,
+QgsProcessingParameterBoolean, QgsProcessingParameterEnum, QgsProcessingParameterFileDestination,
+QgsProcessing, QgsProcessingParameterFeatureSource, QgsFeatureRequest, QgsMapLayer, QgsUnitTypes, Qgis)
 
-from qgis.gui import (QgsRubberBand, QgsMapToolEmitPoint, QgsMapLayerComboBox,
+from qgis.gui import (QgsRubberBand, QgsMapCanvasItem, QgsMapToolEmitPoint, QgsMapLayerComboBox,
 QgsProjectionSelectionWidget)
 
-from PyQt5.QtCore import Qt, QObject, QPointF, QSizeF, QMarginsF, pyqtSignal
+from PyQt5.QtCore import (Qt, QObject, QRectF, QMarginsF, QPointF, QByteArray, QBuffer, QIODevice, QTimer,
+pyqtSignal)
 
-from PyQt5.QtGui import QColor, QTextDocument, QCursor, QIcon
+from PyQt5.QtGui import QColor, QCursor, QIcon, QImage, QImageWriter, QPainter, QPainterPath, QPolygonF
 
 from PyQt5.QtWidgets import (QDockWidget, QWidget, QDialog, QHBoxLayout, QLabel, QLineEdit, QToolBar,
 QAction, QMenu, QSpinBox, QDoubleSpinBox, QAbstractSpinBox, QPushButton, QProgressBar, QMessageBox,
-QFileDialog, QGridLayout, QCheckBox)
+QFileDialog, QGridLayout, QVBoxLayout, QCheckBox, QComboBox, QListWidget, QListWidgetItem, QTableWidget,
+QTableWidgetItem, QHeaderView)
 
 class Basemap2Geopackage:
     
@@ -46,12 +63,23 @@ class Basemap2Geopackage:
         self.project_crs = self.project.crs()
         #####
         self.coverage_layer = None
-        self.grid_rubber_bands = []
-        self.grid_annotations = []
+        self.coverage_selected = False# only the selected features of coverage_layer
+        self.aoi = None# area of interest geometry in the project crs, cells outside it are left out
+        self.mask_to_aoi = False# also make the pixels outside the aoi transparent
+        self.grid = None
+        self.grid_view = gridView(self.canvas)
+        # Coalesce bursts of spinbox changes (e.g. holding an arrow) into one redraw
+        self.redraw_timer = QTimer()
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(150)
+        self.redraw_timer.timeout.connect(self.draw_visuals)
+        self.default_pixel_size = resolutionEngine.fallback
         self.layer_extent_dialog = None
         self.map_tool = None
         self.rect = None
         self.log = QgsMessageLog()
+        options = exportOptions.from_settings()
+        self.queue = exportQueue(options.max_jobs, options.max_total_requests)
         #####
         # Keep track of signal/slot connections
         self.slot1 = 'Not connected'# layer added to project
@@ -60,14 +88,18 @@ class Basemap2Geopackage:
 #        print(self.launch_action)
         
     def initGui(self):
+        self.initProcessing()
         #10-1-2024
         self.launch_action = QAction(QIcon(self.icon_path), 'Basemap2gpkg', self.iface.mainWindow())
         self.launch_action.setObjectName('btnBM2GPKG')
         #10-1-2024
         self.extent_inputs = [c for c in self.dlg.widget.findChildren(QLineEdit)]
+        for e in self.extent_inputs:
+            # typing an extent replaces the layer the grid was clipped to
+            e.textEdited.connect(self.clear_aoi)
         self.grid_inputs = [b for b in self.dlg.widget.findChildren(QSpinBox)]
         for j in self.grid_inputs:
-            j.valueChanged.connect(self.draw_visuals)
+            j.valueChanged.connect(self.redraw_timer.start)
         
         self.launch_action.triggered.connect(self.plugin_launched)
         self.toolbar.addAction(self.launch_action)
@@ -86,8 +118,12 @@ class Basemap2Geopackage:
         self.dlg.action2.triggered.connect(self.show_map_layer_dialog)
         self.dlg.action3.triggered.connect(self.reset_from_canvas_extent)
         self.dlg.res_btn.clicked.connect(self.customise_grid)
+        self.dlg.cb_align.toggled.connect(self.redraw_timer.start)
         self.dlg.dwnld_btn.clicked.connect(self.run_save_task)
         self.dlg.was_closed.connect(self.dockwidget_closed)
+        self.dlg.cancel_btn.clicked.connect(self.cancel_all_jobs)
+        self.dlg.job_clicked.connect(self.job_clicked)
+        self.queue.changed.connect(self.queue_changed)
         self.iface.projectMenu().aboutToShow.connect(self.project_menu_opened)
         
         #10-1-2024
@@ -95,6 +131,7 @@ class Basemap2Geopackage:
     
     def new_project_opened(self):
         self.manage_action_settings()
+        self.clear_aoi()
         if self.slot1 == 'Connected':
             self.project.layersAdded.disconnect(self.manage_action_settings)
             self.slot1 = 'Not connected'
@@ -163,7 +200,12 @@ class Basemap2Geopackage:
         self.map_tool = mapToolCustomise(self.canvas, self)
         self.canvas.setMapTool(self.map_tool)
     
+    def clear_aoi(self):
+        self.aoi = None
+        self.mask_to_aoi = False
+
     def get_canvas_extent(self):
+        self.clear_aoi()
         self.dlg.le_left.setText(str(round(self.canvas.extent().xMinimum(), 5)))
         self.dlg.le_bottom.setText(str(round(self.canvas.extent().yMinimum(), 5)))
         self.dlg.le_right.setText(str(round(self.canvas.extent().xMaximum(), 5)))
@@ -183,7 +225,10 @@ class Basemap2Geopackage:
     def get_layer_extent(self):
         if self.coverage_layer is not None:
             #transform layer extent to project crs
-            rec = self.coverage_layer.extent()
+            if self.coverage_selected and self.coverage_layer.selectedFeatureCount():
+                rec = self.coverage_layer.boundingBoxOfSelected()
+            else:
+                rec = self.coverage_layer.extent()
             src = self.coverage_layer.crs()
             tgt = self.project.crs()
             lyr_ext = self.transform_rect(rec, src, tgt)
@@ -198,12 +243,30 @@ class Basemap2Geopackage:
             self.rect = lyr_ext
             self.draw_visuals()#Added in refactor 18/05/21
             
-    def set_grid_to_layer_extent(self):
+    def set_grid_to_layer_extent(self, clip=False):
 #        print(self.rect())
+        self.aoi = self.layer_geometry() if clip else None
         self.get_layer_extent()
         self.canvas.setExtent(self.rect)
         self.canvas.zoomByFactor(1.05)
             
+    def layer_geometry(self):
+        '''Union of the (selected) features of coverage_layer in the project
+        crs, or None for raster layers'''
+        layer = self.coverage_layer
+        if layer is None or layer.type() != QgsMapLayer.VectorLayer:
+            return None
+        if self.coverage_selected and layer.selectedFeatureCount():
+            features = layer.getSelectedFeatures()
+        else:
+            features = layer.getFeatures(QgsFeatureRequest().setNoAttributes())
+        geometry = QgsGeometry.unaryUnion([f.geometry() for f in features if f.hasGeometry()])
+        if geometry.isNull() or geometry.isEmpty():
+            return None
+        if layer.crs() != self.project.crs():
+            geometry.transform(QgsCoordinateTransform(layer.crs(), self.project.crs(), self.project))
+        return geometry
+
     def transform_rect(self, rect, src_crs, target_crs):
         '''Helper function to transform a map layer extent to the project CRS'''
         xforma = QgsCoordinateTransform(src_crs, target_crs, QgsProject.instance())
@@ -218,12 +281,10 @@ class Basemap2Geopackage:
         new_crs = self.project.crs() # get current project crs
 #        print('New Crs: {}'.format(new_crs))
         xformb = QgsCoordinateTransform(old_crs, new_crs, self.project)
-        if self.grid_rubber_bands is not None:
-            for rb in self.grid_rubber_bands:
-                geom = rb[0].asGeometry()
-                rb[0].reset()
-                geom.transform(xformb)
-                rb[0].setToGeometry(geom)
+        if self.aoi is not None:
+            self.aoi.transform(xformb)
+        if self.grid is not None:
+            self.grid.reproject(xformb)
             self.draw_from_stored_lists()
         transformed_extent = xformb.transform(self.rect)
 #        print(transformed_extent)
@@ -237,101 +298,120 @@ class Basemap2Geopackage:
                 
     def draw_visuals(self):
 #        print('draw_visuals_called')
-#        print(self.grid_rubber_bands)
-        self.clear_annotations()
+        self.redraw_timer.stop()
         sides = [i for i in self.extent_inputs]
-        self.clear_annotations()
         self.rect = QgsRectangle(float(sides[0].text()),
                                 float(sides[1].text()),
                                 float(sides[2].text()),
                                 float(sides[3].text()))
         if self.rect is not None:
             self.draw_tile_grid()
-        if self.grid_rubber_bands:
+        if self.grid:
             self.draw_from_stored_lists()
         
-        self.dlg.prog_lbl.setText('0/{}'.format(str(len(self.grid_rubber_bands))))
+        if not self.queue.active():
+            self.dlg.prog_lbl.setText('0/{}'.format(str(len(self.grid) if self.grid else 0)))
         
     def draw_from_stored_lists(self):
         '''
-        show rubber bands stored in self.grid_rubber_bands nested list
-        create annotations for the pixels size value stored at index 1 (2nd item) of each sublist
+        show the cells of self.grid with a pixel size label for each cell
         '''
-        self.clear_annotations()
-        for rb in self.grid_rubber_bands:
-            rb[0].show()
-            annot = self.resolution_annotation(rb)
-            self.grid_annotations.append(annot)
-        for a in self.grid_annotations:
-            self.project.annotationManager().addAnnotation(a)
-    
-    def resolution_annotation(self, rb):
-#        print(len(str(rb[1])))
-        a = QgsTextAnnotation()
-        a.setDocument(QTextDocument('{}m'.format(str(rb[1]))))
-        a.setMarkerSymbol(None)
-        sym = QgsFillSymbol()
-        sym_lyr = sym.symbolLayer(0)
-        sym_lyr.setFillColor(QColor('Light Grey'))
-        sym_lyr.setStrokeColor(QColor('Black'))
-        a.setFillSymbol(sym)
-        a.setFrameOffsetFromReferencePointMm(QPointF(-5, -5))
-        # Calculate annotation frame size...
-        # (text document size plus 1mm margins)
-        doc_size = a.document().size()
-        frame_margins = QMarginsF(1.0, 1.0, 1.0, 1.0)
-        frame_size = doc_size.grownBy(frame_margins)
-        a.setFrameSize(frame_size)#14/4/2024
-        a.setMapPosition(rb[0].asGeometry().boundingBox().center())
-        return a
+        layer = self.basemap_layer()
+        self.grid_view.show(self.grid, size_units(layer.crs() if layer is not None else None)[1])
+        self.update_estimate()
+
+    def grid_cells(self):
+        '''Plain [extent, pixel size] copy of the grid'''
+        return self.grid.cells() if self.grid is not None else []
+
+    def estimate(self, source, target_crs, options, build_overviews=True, cells=None):
+        planner = exportPlanner(self.project.crs(), source.crs(), target_crs, self.project)
+        return exportEstimate(planner, cells if cells is not None else self.grid_cells(), resolutionEngine(source),
+                            source_id(source), options, build_overviews)
+
+    def convert_pixel_sizes(self, cells, layer, other):
+        '''cells with pixel sizes in the crs units of layer (the layer the grid
+        was built for) given in the units of other instead, keeping the
+        number of pixels across each cell'''
+        if other == layer or other.crs() == layer.crs():
+            return cells
+        crs = self.project.crs()
+        a = exportPlanner(crs, layer.crs(), crs, self.project)
+        b = exportPlanner(crs, other.crs(), crs, self.project)
+        converted = []
+        for rect, pixel_size in cells:
+            width = a.source_extent(rect).width()
+            converted.append([rect, pixel_size*b.source_extent(rect).width()/width if width > 0 else pixel_size])
+        return converted
+
+    def update_estimate(self):
+        '''Show the size of the job in the dock before anything is downloaded'''
+        source = self.basemap_layer()
+        if source is None or not self.grid:
+            self.dlg.est_lbl.setText('')
+            self.dlg.est_lbl.setToolTip('')
+            return
+        try:
+            est = self.estimate(source, self.project.crs(), exportOptions.from_settings())
+        except QgsCsException:
+            self.dlg.est_lbl.setText('')
+            return
+        self.dlg.est_lbl.setText(est.summary())
+        self.dlg.est_lbl.setToolTip(est.details())
     
+    def basemap_layer(self):
+        '''The wms/wmts layer to export: the active layer, or else the first
+        one in the project'''
+        layer = self.iface.activeLayer()
+        if layer is not None and layer.providerType() == 'wms':
+            return layer
+        wms_layers = [l for l in QgsProject.instance().mapLayers().values() if l.providerType() == 'wms']
+        return wms_layers[0] if wms_layers else None
+
+    def resolution_engine(self):
+        return resolutionEngine(self.basemap_layer())
+
     def draw_tile_grid(self):
         self.clear_grid()
+        self.default_pixel_size = self.resolution_engine().default_pixel_size(self.canvas, self.project)
         tile_rows = self.dlg.sb_num_tile_rows.value()
         tile_cols = self.dlg.sb_num_tile_cols.value()
-        tile_width = self.rect.width()/tile_cols
-        tile_height = self.rect.height()/tile_rows
-    ####30-04
-        left = self.rect.xMinimum()
-        bottom = self.rect.yMinimum()
-        ##Create grid rbs
-        for r in range(tile_rows):
-            self.create_row(left, bottom, tile_cols, tile_width, tile_height)
-            bottom+=tile_height
-#            print(bottom)
-        
-    ####30-04
-    def make_rect(self, left, bottom, width, height):
-        right = left+width
-        top = bottom+height
-        rect = QgsRectangle(left, bottom, right, top)
-        rb = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
-        rb.setStrokeColor(QColor('Black'))
-        rb.setWidth(1)
-        rb.setToGeometry(QgsGeometry().fromRect(rect))
-        return rb
-
-    def create_row(self, left, bottom, cols, width, height):
-        for c in range(cols):
-            self.grid_rubber_bands.append([self.make_rect(left, bottom, width, height), 5.0])##The (hardcoded) 5 is the problem!
-            left+=width
+        self.grid = tileGrid(self.rect, tile_rows, tile_cols, self.default_pixel_size)
+        if self.dlg.cb_align.isChecked():
+            self.align_grid()
+        if self.aoi is not None:
+            self.grid.clip(self.aoi)
+            if not len(self.grid):
+                self.log.logMessage('No grid cells intersect the area of interest', level=Qgis.Warning)
+
+    def align_grid(self):
+        '''Snap the grid edges to the basemap's tile matrix at the coarsest
+        pixel size in the grid (its tile edges are also edges at every finer
+        zoom level) and show the adjusted extent in the extent inputs'''
+        layer = self.basemap_layer()
+        if layer is None or layer.crs() != self.project.crs():
+            self.log.logMessage('Grid not aligned: the project crs must match the basemap crs ({})'.format(
+                                layer.crs().authid() if layer is not None else 'no basemap'), level=Qgis.Warning)
+            return
+        engine = resolutionEngine(layer)
+        if not engine.has_matrix_origin():
+            self.log.logMessage('Grid not aligned: aligning is only supported for XYZ basemaps', level=Qgis.Warning)
+            return
+        coarsest = max([self.grid.px[i] for i in self.grid.indices()] or [self.default_pixel_size])
+        merged = self.grid.align(engine.tile_span(coarsest), *engine.tile_origin())
+        if merged:
+            self.log.logMessage('Aligning merged {} rows/columns narrower than a server tile'.format(merged),
+                                level=Qgis.Warning)
+        self.rect = self.grid.extent()
+        self.dlg.le_left.setText(str(round(self.rect.xMinimum(), 5)))
+        self.dlg.le_bottom.setText(str(round(self.rect.yMinimum(), 5)))
+        self.dlg.le_right.setText(str(round(self.rect.xMaximum(), 5)))
+        self.dlg.le_top.setText(str(round(self.rect.yMaximum(), 5)))
             
     def clear_grid(self):
     ####30-04
-        if self.grid_rubber_bands:
-            for rb in self.grid_rubber_bands:
-                if rb[0] is not None:
-                    rb[0].reset()
-            self.grid_rubber_bands.clear()
-        self.clear_annotations()
-
-    def clear_annotations(self):
-        if self.grid_annotations:
-            for a in self.grid_annotations:
-                self.project.annotationManager().removeAnnotation(a)
-            self.canvas.refresh()
-            self.grid_annotations.clear()
-    #        print(self.project.annotationManager().annotations())
+        self.grid_view.clear()
+        self.grid = None
         
     #----------------Create task---------------------------------------#
         
@@ -357,53 +437,91 @@ class Basemap2Geopackage:
                 overview_flag = True
             elif self.save_dlg.cb_overviews.checkState() == 0:
                 overview_flag = False
-            #Create task
-            self.task = saveRasters('Save Raster Tiles to Geopackage',
-                                    self.project,
-                                    self.grid_rubber_bands,
-                                    source,
-                                    file_path,
-                                    target_crs,
-                                    overview_flag)
-            self.task.progressChanged.connect(lambda: self.dlg.prog.setValue(int(self.task.progress())))
-            self.task.currentChanged.connect(self.current_changed)
-            self.task.done.connect(self.task_done)
-            #self.task.taskTerminated.connect(self.task_terminated)
-            self.task.begun.connect(lambda: self.dlg.cancel_btn.setEnabled(True))#10-21-2024
-            self.cancel_conn = self.dlg.cancel_btn.clicked.connect(self.cancel_task)#10-21-2024
-            
-            QgsApplication.taskManager().addTask(self.task)
+            options = self.save_dlg.get_options()
+            sources = self.save_dlg.selected_sources()
+            if not sources:
+                self.msg.setText('Please check at least one basemap to export')
+                self.msg.show()
+                return
+            # The grid's pixel sizes are in the units of the basemap it was
+            # built for, the first checked source may be another layer
+            reference = self.basemap_layer()
+            cells = self.grid_cells()
+            try:
+                cells = self.convert_pixel_sizes(cells, reference, sources[0])
+                est = self.estimate(sources[0], target_crs, options, overview_flag, cells)
+                for other in sources[1:]:
+                    est.add(self.estimate(other, target_crs, options, overview_flag,
+                                        self.convert_pixel_sizes(cells, sources[0], other)))
+            except QgsCsException as e:
+                self.msg.setText('The grid could not be transformed to the basemap crs: {}'.format(e))
+                self.msg.show()
+                return
+            if est.size > options.warn_size_gb*1024**3:
+                m = QMessageBox(QMessageBox.Warning, 'Large export',
+                                'This export is estimated at {}.\n\n{}\n\nStart it anyway?'.format(
+                                human_size(est.size), est.details()),
+                                QMessageBox.Yes | QMessageBox.No)
+                if m.exec_() != QMessageBox.Yes:
+                    return
+            #Queue the task, it starts once a slot in the queue is free. The
+            #cells, their crs and the aoi are taken now, later edits (or a change
+            #of project crs) go to the next export
+            grid_crs = QgsCoordinateReferenceSystem(self.project.crs())
+            mask = QgsGeometry(self.aoi) if self.mask_to_aoi and self.aoi is not None else None
+            self.queue.set_limits(options.max_jobs, options.max_total_requests)
+            self.queue.add('{} ({})'.format(os.path.basename(file_path), ', '.join(s.name() for s in sources)),
+                        lambda budget: saveRasters('Save Raster Tiles to Geopackage',
+                                                    self.project,
+                                                    cells,
+                                                    sources if len(sources) > 1 else sources[0],
+                                                    file_path,
+                                                    target_crs,
+                                                    overview_flag,
+                                                    options,
+                                                    grid_crs=grid_crs,
+                                                    mask=mask,
+                                                    budget=budget))
     
     #10-1-2024
-    def cancel_task(self):
-        self.task.cancel()
-        QObject.disconnect(self.cancel_conn)
+    def cancel_all_jobs(self):
+        self.queue.cancel_all()
         self.dlg.cancel_btn.setIcon(QIcon(':images/themes/default/mIconLoading.gif'))
-        self.dlg.cancel_btn.setToolTip('Waiting for task to Terminate...')
+        self.dlg.cancel_btn.setToolTip('Waiting for tasks to Terminate...')
     
-    def current_changed(self, lbl_txt):
-        self.dlg.prog_lbl.setText(lbl_txt)
+    def job_clicked(self, job):
+        if job.active():
+            self.queue.cancel(job)
+        else:
+            self.queue.remove(job)
     
-    def task_done(self, result):
-        self.dlg.prog.setValue(0)
-        self.dlg.prog_lbl.setText('0/{}'.format(str(len(self.grid_rubber_bands))))
-        if result == False:
-            self.log.logMessage('Task not completed or was cancelled!')
+    def queue_changed(self):
+        '''Show the state of the export queue in the dock: a row per job and
+        the overall progress of the jobs still to finish'''
+        self.dlg.show_jobs(self.queue.jobs)
+        active = self.queue.active()
+        running = self.queue.running()
+        if active:
+            self.dlg.prog.setValue(int(sum(j.percent for j in active)/len(active)))
+            if len(active) == 1 and running and running[0].label:
+                self.dlg.prog_lbl.setText(running[0].label)
+            else:
+                self.dlg.prog_lbl.setText('{} running, {} queued'.format(len(running), len(active)-len(running)))
+            if not any(j.status == 'Cancelling' for j in active):
+                self.dlg.cancel_btn.setIcon(QIcon(':images/themes/default/pluginDeprecated.svg'))
+                self.dlg.cancel_btn.setToolTip('Cancel all exports')
         else:
-            self.log.logMessage('Geopackage created successfully', level=Qgis.Info)
-            QObject.disconnect(self.cancel_conn)
-        #QObject.disconnect(self.cancel_conn)
-        self.dlg.cancel_btn.setEnabled(False)
-        self.dlg.cancel_btn.setIcon(QIcon(':images/themes/default/pluginDeprecated.svg'))
+            self.dlg.prog.setValue(0)
+            self.dlg.prog_lbl.setText('0/{}'.format(str(len(self.grid) if self.grid else 0)))
+            self.dlg.cancel_btn.setIcon(QIcon(':images/themes/default/pluginDeprecated.svg'))
+            self.dlg.cancel_btn.setToolTip('Cancel all exports')
+        self.dlg.cancel_btn.setEnabled(bool(active))
         
     
     def dockwidget_closed(self):
         ####30-04
         self.clear_grid()
-        self.clear_annotations()
         self.rect = None
-        if len(self.project.annotationManager().annotations()) > 0:
-            self.clear_annotations()
         if self.canvas.mapTool() == self.map_tool:
             self.iface.actionPan().trigger()
         ###02-08-21###
@@ -415,17 +533,24 @@ class Basemap2Geopackage:
         ###23-05-21###
         self.project.crsChanged.disconnect(self.project_crs_changed)
 
+    def initProcessing(self):
+        self.provider = basemap2GeopackageProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
     def unload(self):
+        self.queue.cancel_all()
         self.toolbar.removeAction(self.launch_action)
         del self.launch_action
+        QgsApplication.processingRegistry().removeProvider(self.provider)
             
     #--------------------------------------------------------------------------#
 class setAOIGrid(QDockWidget):
     was_closed = pyqtSignal()
+    job_clicked = pyqtSignal(object)# cancel a running or queued job, remove a finished one
     def __init__(self):
         QDockWidget.__init__(self)
         self.widget = QWidget(self)
-        self.layout = QHBoxLayout(self)
+        self.layout = QHBoxLayout()
         #Extent_inputs
         self.lbl_left = QLabel('X Min:', self.widget)
         self.le_left = QLineEdit(self.widget)
@@ -459,94 +584,2695 @@ class setAOIGrid(QDockWidget):
         self.sb_num_tile_cols.setMinimum(1)
         self.sb_num_tile_cols.setValue(2)
         self.res_btn = QPushButton('Customize', self.widget)
+        self.cb_align = QCheckBox('Align', self.widget)
+        self.cb_align.setToolTip('Snap cell edges to the server tile grid so neighbouring cells\n'
+                                'never fetch the same tile (XYZ basemaps only, the project crs\n'
+                                'must match the basemap crs)')
+        self.est_lbl = QLabel('', self.widget)
         self.dwnld_btn = QPushButton('Download', self.widget)
         self.prog_lbl = QLabel('0/4', self.widget)
         self.prog = QProgressBar(self.widget)
         self.cancel_btn = QPushButton(QIcon(':images/themes/default/pluginDeprecated.svg'), '', self.widget)
-        self.cancel_btn.setToolTip('Cancel Process')
+        self.cancel_btn.setToolTip('Cancel all exports')
         #self.cancel_btn.setEnabled(False)
         for w in self.widget.children():
             self.layout.addWidget(w)
-        self.widget.setLayout(self.layout)
+        #Job table, one row per export in the queue
+        self.jobs_table = QTableWidget(0, 5, self.widget)
+        self.jobs_table.setHorizontalHeaderLabels(['Export', 'Status', 'Progress', 'ETA', ''])
+        self.jobs_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.jobs_table.verticalHeader().hide()
+        self.jobs_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.jobs_table.setSelectionMode(QTableWidget.NoSelection)
+        self.jobs_table.setMaximumHeight(150)
+        self.jobs_table.hide()
+        self.job_rows = []
+        self.main_layout = QVBoxLayout()
+        self.main_layout.addLayout(self.layout)
+        self.main_layout.addWidget(self.jobs_table)
+        self.widget.setLayout(self.main_layout)
         self.setWidget(self.widget)
         
+    def show_jobs(self, jobs):
+        '''Fill the job table from the exportQueue jobs'''
+        if self.job_rows != jobs[:len(self.job_rows)]:
+            # a job was taken off the list
+            self.jobs_table.setRowCount(0)
+            self.job_rows = []
+        for job in jobs[len(self.job_rows):]:
+            row = self.jobs_table.rowCount()
+            self.jobs_table.insertRow(row)
+            self.jobs_table.setItem(row, 0, QTableWidgetItem(job.name))
+            self.jobs_table.item(row, 0).setToolTip(job.name)
+            self.jobs_table.setItem(row, 1, QTableWidgetItem())
+            self.jobs_table.setCellWidget(row, 2, QProgressBar(self.jobs_table))
+            self.jobs_table.setItem(row, 3, QTableWidgetItem())
+            btn = QPushButton(self.jobs_table)
+            btn.clicked.connect(lambda checked, job=job: self.job_clicked.emit(job))
+            self.jobs_table.setCellWidget(row, 4, btn)
+            self.job_rows.append(job)
+        for row, job in enumerate(self.job_rows):
+            self.jobs_table.item(row, 1).setText(job.status_text())
+            self.jobs_table.cellWidget(row, 2).setValue(int(job.percent))
+            eta = job.eta()
+            self.jobs_table.item(row, 3).setText(human_time(eta) if eta is not None else '')
+            btn = self.jobs_table.cellWidget(row, 4)
+            if job.active():
+                btn.setIcon(QIcon(':images/themes/default/pluginDeprecated.svg'))
+                btn.setToolTip('Cancel this export')
+                btn.setEnabled(job.status != 'Cancelling')
+            else:
+                btn.setIcon(QIcon(':images/themes/default/mActionRemove.svg'))
+                btn.setToolTip('Remove from the list')
+                btn.setEnabled(True)
+        self.jobs_table.setVisible(bool(self.job_rows))
+
     def closeEvent(self, e):
         self.was_closed.emit()
 
+###---------------------Tile Grid Classes---------------------------------###
+class tileGrid:
+    '''The download grid as plain data: rows+1 and cols+1 cell edges plus a
+    pixel size and an active flag per cell. Cell i is row i//cols (counted
+    from the bottom) and column i%cols (counted from the left). Removed
+    cells stay in the arrays with active set to 0 so indices never shift'''
+    def __init__(self, rect, rows, cols, pixel_size):
+        self.rows = rows
+        self.cols = cols
+        w = rect.width()/cols
+        h = rect.height()/rows
+        self.xs = array('d', [rect.xMinimum()+c*w for c in range(cols)]+[rect.xMaximum()])
+        self.ys = array('d', [rect.yMinimum()+r*h for r in range(rows)]+[rect.yMaximum()])
+        self.px = array('d', [pixel_size])*(rows*cols)
+        self.active = bytearray([1])*(rows*cols)
+        # bumped whenever the cell outlines change, pixel size edits do not
+        self.version = 0
+
+    def __len__(self):
+        return self.active.count(1)
+
+    def indices(self):
+        return [i for i, a in enumerate(self.active) if a]
+
+    def cell_rect(self, i):
+        r, c = divmod(i, self.cols)
+        return QgsRectangle(self.xs[c], self.ys[r], self.xs[c+1], self.ys[r+1])
+
+    def center(self, i):
+        r, c = divmod(i, self.cols)
+        return QgsPointXY((self.xs[c]+self.xs[c+1])/2, (self.ys[r]+self.ys[r+1])/2)
+
+    def index_at(self, point):
+        '''Index of the active cell containing point, or None'''
+        c = bisect.bisect_right(self.xs, point.x())-1
+        r = bisect.bisect_right(self.ys, point.y())-1
+        # points on the outer right/top edge belong to the last cell
+        if point.x() == self.xs[-1]:
+            c = self.cols-1
+        if point.y() == self.ys[-1]:
+            r = self.rows-1
+        if not (0 <= c < self.cols and 0 <= r < self.rows):
+            return None
+        i = r*self.cols+c
+        return i if self.active[i] else None
+
+    def indices_in(self, rect):
+        '''Indices of the active cells overlapping rect, found from the
+        edges without visiting the cells outside it'''
+        r0, r1, c0, c1 = self.span(rect)
+        return [r*self.cols+c for r in range(r0, r1+1) for c in range(c0, c1+1)
+                if self.active[r*self.cols+c]]
+
+    def span(self, rect):
+        '''First and last row and column overlapping rect'''
+        c0 = max(bisect.bisect_right(self.xs, rect.xMinimum())-1, 0)
+        c1 = min(bisect.bisect_left(self.xs, rect.xMaximum())-1, self.cols-1)
+        r0 = max(bisect.bisect_right(self.ys, rect.yMinimum())-1, 0)
+        r1 = min(bisect.bisect_left(self.ys, rect.yMaximum())-1, self.rows-1)
+        return r0, r1, c0, c1
+
+    def set_pixel_size(self, i, pixel_size):
+        self.px[i] = pixel_size
+
+    def set_pixel_sizes(self, indices, pixel_size):
+        for i in indices:
+            self.px[i] = pixel_size
+
+    def set_all(self, pixel_size):
+        self.set_pixel_sizes(self.indices(), pixel_size)
+
+    def remove(self, i):
+        self.active[i] = 0
+        self.version += 1
+
+    def remove_many(self, indices):
+        for i in indices:
+            self.active[i] = 0
+        self.version += 1
+
+    def extent(self):
+        return QgsRectangle(self.xs[0], self.ys[0], self.xs[-1], self.ys[-1])
+
+    def cells(self):
+        '''Plain [QgsRectangle, pixel size] snapshot of the active cells, safe
+        to hand to a task thread'''
+        return [[self.cell_rect(i), self.px[i]] for i in self.indices()]
+
+    def clip(self, geometry):
+        '''Remove the cells that don't intersect geometry (in the grid crs),
+        e.g. the polygons of a corridor or an irregular area of interest'''
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+        r0, r1, c0, c1 = self.span(geometry.boundingBox())
+        keep = set()
+        for r in range(r0, r1+1):
+            for c in range(c0, c1+1):
+                i = r*self.cols+c
+                if self.active[i] and engine.intersects(QgsGeometry.fromRect(self.cell_rect(i)).constGet()):
+                    keep.add(i)
+        self.remove_many([i for i in self.indices() if i not in keep])
+
+    def align(self, span, x0, y0):
+        '''Move the edges onto a lattice of span sized squares anchored at
+        (x0, y0), e.g. the tile matrix of the source, so neighbouring cells
+        never need the same server tile. Rows and columns narrower than span
+        whose edges land on the same line are merged into their neighbour
+        (keeping the finer pixel size) rather than pushing the edges out.
+        Returns the number of rows and columns merged away'''
+        xs, col_of = self.snap_edges(self.xs, span, x0)
+        ys, row_of = self.snap_edges(self.ys, span, y0)
+        rows, cols = len(ys)-1, len(xs)-1
+        merged = self.rows-rows+self.cols-cols
+        if merged:
+            px = array('d', [0.0])*(rows*cols)
+            active = bytearray(rows*cols)
+            for i in range(self.rows*self.cols):
+                r, c = divmod(i, self.cols)
+                j = row_of[r]*cols+col_of[c]
+                px[j] = self.px[i] if not px[j] else min(px[j], self.px[i])
+                active[j] = active[j] or self.active[i]
+            self.px, self.active = px, active
+            self.rows, self.cols = rows, cols
+        self.xs, self.ys = xs, ys
+        self.version += 1
+        return merged
+
+    @staticmethod
+    def snap_edges(edges, span, origin):
+        '''Edges rounded to the lattice with duplicates dropped, and the new
+        index of each old cell. Always leaves at least one cell'''
+        snapped = [origin+round((e-origin)/span)*span for e in edges]
+        kept = [snapped[0]]
+        index = []
+        for v in snapped[1:]:
+            if v > kept[-1]:
+                kept.append(v)
+            # a collapsed cell joins the cell before it, or the first one
+            index.append(max(0, len(kept)-2))
+        if len(kept) == 1:
+            # the whole extent is narrower than half a span: one span wide
+            kept.append(kept[0]+span)
+        return array('d', kept), index
+
+    def reproject(self, xform):
+        '''Move the edges to another crs, transforming each one along the
+        centre lines of the grid so the cells stay axis aligned'''
+        cx = (self.xs[0]+self.xs[-1])/2
+        cy = (self.ys[0]+self.ys[-1])/2
+        self.xs = array('d', [xform.transform(QgsPointXY(x, cy)).x() for x in self.xs])
+        self.ys = array('d', [xform.transform(QgsPointXY(cx, y)).y() for y in self.ys])
+        self.version += 1
+
+
+class gridLabels(QgsMapCanvasItem):
+    '''Pixel size labels for the cells of a tileGrid, painted by a single
+    canvas item. Only cells inside the visible extent are drawn. When the
+    cells are too small on screen for a label each, they are labelled in
+    square blocks instead: one value if the block shares a resolution,
+    otherwise the range of values in it'''
+    label_width = 60# screen pixels a label needs before it gets its own cell
+    label_height = 20
+
+    def __init__(self, canvas):
+        QgsMapCanvasItem.__init__(self, canvas)
+        self.canvas = canvas
+        self.grid = None
+        self.suffix = 'm'# map units of the basemap crs
+        self.setZValue(100)
+
+    def set_grid(self, grid, suffix='m'):
+        self.grid = grid
+        self.suffix = suffix
+        if grid is not None:
+            self.setRect(grid.extent())
+        self.setVisible(grid is not None)
+        self.update()
+
+    def block_size(self):
+        '''Number of cells per side of a labelled block at the current scale'''
+        grid = self.grid
+        mupp = self.canvas.mapUnitsPerPixel()
+        cell_w = abs(grid.xs[-1]-grid.xs[0])/grid.cols/mupp
+        cell_h = abs(grid.ys[-1]-grid.ys[0])/grid.rows/mupp
+        if cell_w <= 0 or cell_h <= 0:
+            return max(grid.rows, grid.cols)
+        return max(1, math.ceil(self.label_width/cell_w), math.ceil(self.label_height/cell_h))
+
+    def labels(self, extent):
+        '''(map point, text) pairs for the cells or blocks overlapping extent'''
+        grid = self.grid
+        step = self.block_size()
+        if step == 1:
+            return [(grid.center(i), format_pixel_size(grid.px[i], self.suffix))
+                    for i in grid.indices_in(extent)]
+        r0, r1, c0, c1 = grid.span(extent)
+        labels = []
+        # blocks start on multiples of step so they don't shift while panning
+        for br in range(r0-r0 % step, r1+1, step):
+            re = min(br+step, grid.rows)
+            for bc in range(c0-c0 % step, c1+1, step):
+                ce = min(bc+step, grid.cols)
+                sizes = [grid.px[r*grid.cols+c] for r in range(br, re) for c in range(bc, ce)
+                        if grid.active[r*grid.cols+c]]
+                if not sizes:
+                    continue
+                lo, hi = min(sizes), max(sizes)
+                if lo == hi:
+                    text = format_pixel_size(lo, self.suffix)
+                else:
+                    text = '{}-{}'.format(format_pixel_size(lo), format_pixel_size(hi, self.suffix))
+                point = QgsPointXY((grid.xs[bc]+grid.xs[ce])/2, (grid.ys[br]+grid.ys[re])/2)
+                labels.append((point, text))
+        return labels
+
+    def paint(self, painter, option=None, widget=None):
+        if self.grid is None:
+            return
+        metrics = painter.fontMetrics()
+        painter.setPen(QColor('Black'))
+        painter.setBrush(QColor('Light Grey'))
+        for point, text in self.labels(self.canvas.extent()):
+            frame = QRectF(metrics.boundingRect(text)).marginsAdded(QMarginsF(3, 1, 3, 1))
+            frame.moveCenter(self.toCanvasCoordinates(point)-self.pos())
+            painter.drawRect(frame)
+            painter.drawText(frame, Qt.AlignCenter, text)
+
+
+class gridView:
+    '''Draws a tileGrid on the canvas with one rubber band for all of the
+    cell outlines, one for highlighting cells and one canvas item for the
+    labels. The outlines are only rebuilt when the grid layout changes'''
+    def __init__(self, canvas):
+        self.outline = QgsRubberBand(canvas, QgsWkbTypes.LineGeometry)
+        self.outline.setStrokeColor(QColor('Black'))
+        self.outline.setWidth(1)
+        self.highlight = QgsRubberBand(canvas, QgsWkbTypes.PolygonGeometry)
+        self.highlight.setStrokeColor(QColor('Red'))
+        self.highlight.setFillColor(QColor(255, 0, 0, 40))
+        self.highlight.setWidth(2)
+        self.labels = gridLabels(canvas)
+        self.labels.setVisible(False)
+        self.drawn = None# (grid, version) of the current outlines
+
+    def show(self, grid, suffix='m'):
+        if self.drawn != (grid, grid.version):
+            self.outline.setToGeometry(self.outline_geometry(grid), None)
+            self.drawn = (grid, grid.version)
+        self.outline.show()
+        self.labels.set_grid(grid, suffix)
+
+    def outline_geometry(self, grid):
+        if len(grid) == grid.rows*grid.cols:
+            # complete grid: one line per edge instead of a ring per cell
+            x0, x1, y0, y1 = grid.xs[0], grid.xs[-1], grid.ys[0], grid.ys[-1]
+            lines = [[QgsPointXY(x, y0), QgsPointXY(x, y1)] for x in grid.xs]
+            lines += [[QgsPointXY(x0, y), QgsPointXY(x1, y)] for y in grid.ys]
+            return QgsGeometry.fromMultiPolylineXY(lines)
+        lines = []
+        for i in grid.indices():
+            r = grid.cell_rect(i)
+            lines.append([QgsPointXY(r.xMinimum(), r.yMinimum()), QgsPointXY(r.xMinimum(), r.yMaximum()),
+                        QgsPointXY(r.xMaximum(), r.yMaximum()), QgsPointXY(r.xMaximum(), r.yMinimum()),
+                        QgsPointXY(r.xMinimum(), r.yMinimum())])
+        return QgsGeometry.fromMultiPolylineXY(lines)
+
+    def highlight_cells(self, grid, indices):
+        self.highlight.reset(QgsWkbTypes.PolygonGeometry)
+        for i in indices:
+            self.highlight.addGeometry(QgsGeometry.fromRect(grid.cell_rect(i)), None)
+
+    def clear(self):
+        self.outline.reset(QgsWkbTypes.LineGeometry)
+        self.highlight.reset(QgsWkbTypes.PolygonGeometry)
+        self.labels.set_grid(None)
+        self.drawn = None
+
+###---------------------Resolution Engine Class----------------------------###
+class resolutionEngine:
+    '''Download pixel sizes for a basemap, in source crs units. Tiled sources
+    (WMTS/XYZ) report the resolutions of their tile matrix set; pixel sizes
+    are snapped to those so requests match whole server tiles instead of
+    being resampled from the neighbouring zoom level'''
+    fallback = 5.0
+    tile_size = 256# server tile size assumed for tiled sources
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.resolutions = []
+        if layer is not None and layer.dataProvider() is not None:
+            self.resolutions = sorted(r for r in layer.dataProvider().nativeResolutions() if r > 0)
+
+    def zoom_levels(self):
+        '''(level, resolution) pairs, level 0 being the coarsest'''
+        return list(enumerate(sorted(self.resolutions, reverse=True)))
+
+    def for_zoom(self, level):
+        levels = sorted(self.resolutions, reverse=True)
+        return levels[max(0, min(level, len(levels)-1))]
+
+    def zoom_for(self, pixel_size):
+        '''Level of the native resolution nearest to pixel_size'''
+        snapped = self.snap(pixel_size)
+        for level, res in self.zoom_levels():
+            if res == snapped:
+                return level
+        return None
+
+    def snap(self, pixel_size):
+        '''Nearest native resolution to pixel_size, compared on a log scale'''
+        if not self.resolutions or pixel_size <= 0:
+            return pixel_size
+        return min(self.resolutions, key=lambda r: abs(math.log(r/pixel_size)))
+
+    def tile_span(self, pixel_size):
+        '''Ground width of one server tile at pixel_size. For sources
+        without native resolutions this is one 256px output tile'''
+        return self.tile_size*self.snap(pixel_size)
+
+    def has_matrix_origin(self):
+        '''True if tile_origin is the real top left corner of the tile
+        matrix. That holds for XYZ sources, whose provider extent is the
+        matrix extent, but not for WMTS, where it is the layer's bounding box
+        rather than the TileMatrix TopLeftCorner'''
+        return self.layer is not None and bool(self.resolutions) and 'type=xyz' in self.layer.source()
+
+    def tile_origin(self):
+        '''Top left corner of the tile matrix, taken as the corner of the
+        full extent the provider reports. Only exact where has_matrix_origin'''
+        if self.layer is None or self.layer.dataProvider() is None:
+            return 0.0, 0.0
+        extent = self.layer.dataProvider().extent()
+        return extent.xMinimum(), extent.yMaximum()
+
+    def default_pixel_size(self, canvas, project):
+        '''Pixel size matching what the map canvas currently shows'''
+        width = canvas.mapSettings().outputSize().width()
+        if self.layer is None or width <= 0:
+            return self.fallback
+        xform = QgsCoordinateTransform(project.crs(), self.layer.crs(), project)
+        try:
+            extent = xform.transformBoundingBox(canvas.extent())
+        except QgsCsException:
+            return self.fallback
+        res = extent.width()/width
+        if self.resolutions:
+            return self.snap(res)
+        # two significant figures for sources without native resolutions
+        return float('{:.2g}'.format(res))
+
+###---------------------Export Options Class--------------------------------###
+class exportOptions:
+    '''Download settings for a saveRasters task.
+    Values are remembered between sessions in QgsSettings'''
+    settings_group = 'basemap_2_geopackage'
+    defaults = {'workers': 4,# number of tiles fetched in parallel
+                'batch_size': 25,# raster tables written per geopackage transaction
+                'resume': False,# skip cells already completed in an existing geopackage
+                'cache': True,# read the source through the local response cache
+                'cache_size_mb': 2048,
+                'cache_ttl_days': 30,
+                'offline': False,# serve only from the cache, never contact the server
+                'overview_levels': '2 4 8 16',
+                'overview_resampling': 'average',# or 'nearest'
+                'tile_format': 'PNG',# PNG, JPEG, WEBP or AUTO (JPEG where opaque, PNG elsewhere)
+                'tile_quality': 75,# JPEG/WEBP quality, 1-100
+                'drop_empty': True,# leave fully transparent tiles out
+                'output_mode': 'tables',# a table per grid cell, or 'pyramid' for one tile table
+                'pyramid_table': 'basemap',# table name used in pyramid mode
+                'warn_size_gb': 5,# ask before starting exports estimated larger than this
+                'rate_limit': 0.0,# server requests per second, 0 for no limit
+                'max_requests': 0,# server requests in flight at once, 0 to leave it to the download threads
+                'retries': 3,# attempts after a failed request, with exponential backoff
+                'retry_backoff': 2.0,# seconds before the first retry
+                'memory_budget_mb': 1024,# cells are rendered in parts so blocks in flight stay under this
+                'block_cache_mb': 256,# source blocks kept in memory for neighbouring cells, 0 to turn off. Part of memory_budget_mb, at most half
+                'refresh': False,# re-fetch only the cells of an existing export whose source has changed
+                'probe': False,# store a hash of a small rendering of each cell for refresh, one extra request per cell
+                'probe_size': 64,# pixels per side of the probe rendering
+                'max_jobs': 2,# queued exports run at the same time
+                'max_total_requests': 16}# server requests in flight over all running exports, 0 for no limit
+
+    def __init__(self, **kwargs):
+        for key, value in self.defaults.items():
+            setattr(self, key, kwargs.get(key, value))
+
+    @classmethod
+    def from_settings(cls):
+        s = QgsSettings()
+        values = {}
+        for key, value in cls.defaults.items():
+            values[key] = s.value('{}/{}'.format(cls.settings_group, key), value, type=type(value))
+        return cls(**values)
+
+    def save(self):
+        s = QgsSettings()
+        for key in self.defaults:
+            s.setValue('{}/{}'.format(self.settings_group, key), getattr(self, key))
+
+###---------------------Export Planner Classes-----------------------------###
+class exportPlanner:
+    '''Works out the target crs extent and pixel dimensions of grid cells.
+    Shared by saveRasters and the estimate shown in the dock so both agree.
+    Cell extents are reprojected from points sampled along their edges;
+    the transformed points are kept, so edges shared by neighbouring cells
+    are only transformed once when planning the whole grid. Transforms are
+    skipped between equivalent crs'''
+    edge_segments = 8# segments each cell edge is sampled in when reprojecting it
+
+    def __init__(self, grid_crs, source_crs, target_crs, project):
+        self.grid_crs = grid_crs
+        self.source_crs = source_crs
+        self.target_crs = target_crs
+        # Built per planner, so each one picks up the project's current
+        # transform context (datum operations)
+        self.xform1 = None if grid_crs == source_crs else QgsCoordinateTransform(grid_crs, source_crs, project)
+        self.xform2 = None if grid_crs == target_crs else QgsCoordinateTransform(grid_crs, target_crs, project)
+        self.points = {}
+
+    def project_rect(self, xform, rect):
+        '''Bounding box of rect transformed with xform'''
+        n = self.edge_segments
+        xs = [rect.xMinimum()+rect.width()*i/n for i in range(n)]+[rect.xMaximum()]
+        ys = [rect.yMinimum()+rect.height()*i/n for i in range(n)]+[rect.yMaximum()]
+        edge = ([(x, ys[0]) for x in xs]+[(x, ys[-1]) for x in xs]+
+                [(xs[0], y) for y in ys[1:-1]]+[(xs[-1], y) for y in ys[1:-1]])
+        cache = self.points.setdefault(id(xform), {})
+        px = []
+        py = []
+        for xy in edge:
+            if xy not in cache:
+                p = xform.transform(QgsPointXY(*xy))
+                cache[xy] = (p.x(), p.y())
+            px.append(cache[xy][0])
+            py.append(cache[xy][1])
+        return QgsRectangle(min(px), min(py), max(px), max(py))
+
+    def source_extent(self, tile_rect):
+        if self.xform1 is None:
+            return QgsRectangle(tile_rect)
+        return self.project_rect(self.xform1, tile_rect)
+
+    @staticmethod
+    def snap_edges(cells, x0, y0):
+        '''Snapped position of every distinct cell edge, keyed by ('x' or 'y',
+        edge value). Each edge goes onto the pixel lattice, anchored at (x0, y0),
+        of the coarsest cell touching it, so the cells on either side of an
+        edge share it exactly'''
+        steps = {}
+        for rect, pixel_size in cells:
+            for key in [('x', rect.xMinimum()), ('x', rect.xMaximum()),
+                        ('y', rect.yMinimum()), ('y', rect.yMaximum())]:
+                steps[key] = max(steps.get(key, 0.0), pixel_size)
+        snapped = {}
+        for (axis, v), step in steps.items():
+            o = x0 if axis == 'x' else y0
+            snapped[(axis, v)] = o+round((v-o)/step)*step
+        return snapped
+
+    def plan(self, cells):
+        '''(source extent, target extent, cols, rows) for every [extent,
+        pixel size] cell of a grid, in one pass. Pixel sizes are in source
+        crs units. When no reprojection is involved the cell edges are put
+        on pixel lattices anchored at the grid corner, each shared edge on
+        the lattice of the coarsest cell touching it, so neighbouring cells
+        share exact edges with no seams or overlaps. Where a cell's edges are
+        on a coarser neighbour's lattice its pixel count is rounded, so its
+        effective pixel size can differ slightly from the one asked for'''
+        planned = []
+        aligned = self.xform1 is None and self.xform2 is None and cells
+        if aligned:
+            x0 = min(r.xMinimum() for r, px in cells)
+            y0 = min(r.yMinimum() for r, px in cells)
+            edges = self.snap_edges(cells, x0, y0)
+        for tile_rect, pixel_size in cells:
+            if aligned:
+                extent_src = QgsRectangle(edges[('x', tile_rect.xMinimum())], edges[('y', tile_rect.yMinimum())],
+                                        edges[('x', tile_rect.xMaximum())], edges[('y', tile_rect.yMaximum())])
+                target = QgsRectangle(extent_src)
+            else:
+                extent_src = self.source_extent(tile_rect)
+                target = tile_rect if self.xform2 is None else self.project_rect(self.xform2, tile_rect)
+            planned.append((extent_src, target, int(round(extent_src.width()/pixel_size)),
+                            int(round(extent_src.height()/pixel_size))))
+        return planned
+
+
+def size_units(crs):
+    '''(name, suffix) of the map units of crs, which pixel sizes are given in'''
+    if crs is None or not crs.isValid():
+        return 'meters', 'm'
+    units = crs.mapUnits()
+    if units == QgsUnitTypes.DistanceDegrees:
+        return 'degrees', '\u00b0'
+    return QgsUnitTypes.toString(units), QgsUnitTypes.toAbbreviatedString(units)
+
+
+def format_pixel_size(value, suffix=''):
+    '''Pixel size to six significant figures, so degrees read as well as metres'''
+    return '{:.6g}{}'.format(value, suffix)
+
+
+def human_size(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n < 1024:
+            return '{:.1f} {}'.format(n, unit) if unit != 'B' else '{} B'.format(int(n))
+        n /= 1024
+    return '{:.1f} TB'.format(n)
+
+
+def human_time(seconds):
+    if seconds < 90:
+        return '{} s'.format(int(seconds))
+    if seconds < 5400:
+        return '{} min'.format(int(round(seconds/60)))
+    return '{:.1f} h'.format(seconds/3600)
+
+
+class exportEstimate:
+    '''Size of an export worked out from the grid alone, without fetching
+    anything: total pixels, server requests, geopackage size and an ETA
+    based on the throughput measured on earlier exports'''
+    # rough stored size of 256px tiles of imagery, by tile format
+    bytes_per_pixel = {'PNG': 2.0, 'JPEG': 0.35, 'WEBP': 0.25, 'AUTO': 0.45}
+
+    def __init__(self, planner, cells, engine, source_uri, options, build_overviews=True):
+        self.tables = len(cells)
+        self.pixels = 0
+        self.requests = 0
+        # plain WMS goes through the block grid when either cache is on
+        blocked = options.cache or options.block_cache_mb > 0
+        for (src_extent, extent, cols, rows), (tile_rect, pixel_size) in zip(planner.plan(cells), cells):
+            self.pixels += max(0, cols)*max(0, rows)
+            self.requests += self.cell_requests(src_extent, pixel_size, engine, blocked)
+            if options.probe and cols > 0 and rows > 0:
+                # the probe of the cell is read straight from the server
+                probe_pixel = max(src_extent.width(), src_extent.height())/options.probe_size
+                self.requests += self.cell_requests(src_extent, probe_pixel, engine, False)
+        factor = 1.0
+        if build_overviews:
+            factor += sum(1/f**2 for f in overview_factors(options.overview_levels))
+        self.size = self.pixels*self.bytes_per_pixel.get(options.tile_format.upper(), 2.0)*factor
+        self.throughput = self.measured_throughput(source_uri)
+        self.seconds = self.pixels/self.throughput if self.throughput else None
+
+    def add(self, other):
+        '''Fold in the estimate for another source exported over the same grid'''
+        self.tables += other.tables
+        self.pixels += other.pixels
+        self.requests += other.requests
+        self.size += other.size
+        self.seconds = self.pixels/self.throughput if self.throughput else None
+
+    def cell_requests(self, src_extent, pixel_size, engine, blocked):
+        '''Server requests needed for one cell: whole server tiles for tiled
+        sources, cache blocks for plain WMS read through a cache, otherwise
+        a single GetMap'''
+        x0 = y0 = 0.0
+        if engine.resolutions:
+            span = engine.tile_span(pixel_size)
+            x0, y0 = engine.tile_origin()
+        elif blocked:
+            span = sourceInterface.block_size*2**(math.floor(math.log2(pixel_size)*4)/4)
+        else:
+            return 1
+        # cells ending exactly on a tile edge don't touch the next tile
+        nx = math.ceil((src_extent.xMaximum()-x0)/span)-math.floor((src_extent.xMinimum()-x0)/span)
+        ny = math.ceil((src_extent.yMaximum()-y0)/span)-math.floor((src_extent.yMinimum()-y0)/span)
+        return max(1, nx*ny)
+
+    @staticmethod
+    def settings_key(source_uri):
+        return '{}/throughput/{}'.format(exportOptions.settings_group,
+                                        hashlib.sha1(source_uri.encode('utf-8')).hexdigest()[:12])
+
+    @classmethod
+    def measured_throughput(cls, source_uri):
+        '''Pixels per second seen on earlier exports of this source, or of
+        any source if this one has not been exported before'''
+        s = QgsSettings()
+        value = s.value(cls.settings_key(source_uri), 0.0, type=float)
+        if not value:
+            value = s.value('{}/throughput/all'.format(exportOptions.settings_group), 0.0, type=float)
+        return value
+
+    @classmethod
+    def record_throughput(cls, source_uri, pixels, seconds):
+        '''Fold the throughput of a finished export into the stored averages'''
+        if pixels <= 0 or seconds <= 1:
+            return
+        s = QgsSettings()
+        measured = pixels/seconds
+        for key in [cls.settings_key(source_uri), '{}/throughput/all'.format(exportOptions.settings_group)]:
+            old = s.value(key, 0.0, type=float)
+            s.setValue(key, measured if not old else 0.7*old+0.3*measured)
+
+    def summary(self):
+        eta = human_time(self.seconds) if self.seconds is not None else '?'
+        return '{:.1f} Mpx | ~{} requests | ~{} | ETA {}'.format(self.pixels/1e6, self.requests,
+                                                                human_size(self.size), eta)
+
+    def details(self):
+        lines = ['Tiles: {}'.format(self.tables),
+                'Pixels: {:,}'.format(self.pixels),
+                'Estimated server requests: {:,}'.format(self.requests),
+                'Estimated geopackage size: {}'.format(human_size(self.size))]
+        if self.throughput:
+            lines.append('Estimated time: {} (at {:.0f} px/s measured on earlier exports)'.format(
+                        human_time(self.seconds), self.throughput))
+        else:
+            lines.append('Estimated time: unknown until a first export has been run')
+        return '\n'.join(lines)
+
+###---------------------Export Statistics Class----------------------------###
+class exportStats:
+    '''Per tile timings and counters collected while an export runs. The
+    stages are fetch (waiting on the server or cache), reproject (projector
+    and resampling), encode, write, overviews (reading, resampling and
+    encoding in the overview builder) and overview_write (inserting them).
+    Stage times are summed over all worker threads so their shares show
+    where the time goes'''
+    stages = ['fetch', 'reproject', 'encode', 'write', 'overviews', 'overview_write']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tiles = collections.OrderedDict()
+        self.start = time.time()
+        self.end = None
+
+    def tile(self, table):
+        if table not in self.tiles:
+            counters = {stage: 0.0 for stage in self.stages}
+            counters.update({'pixels': 0, 'bytes': 0, 'retries': 0})
+            self.tiles[table] = counters
+        return self.tiles[table]
+
+    def add(self, table, stage, seconds):
+        with self.lock:
+            self.tile(table)[stage] += seconds
+
+    def count(self, table, key, n=1):
+        with self.lock:
+            self.tile(table)[key] += n
+
+    def stop(self):
+        self.end = time.time()
+
+    def summary(self, **extra):
+        with self.lock:
+            tiles = collections.OrderedDict((k, dict(v)) for k, v in self.tiles.items())
+        elapsed = (self.end or time.time())-self.start
+        pixels = sum(t['pixels'] for t in tiles.values())
+        nbytes = sum(t['bytes'] for t in tiles.values())
+        busy = sum(t[stage] for t in tiles.values() for stage in self.stages) or 1.0
+        stages = {}
+        for stage in self.stages:
+            values = [t[stage] for t in tiles.values()] or [0.0]
+            stages[stage] = {'total_s': round(sum(values), 3),
+                            'mean_s': round(sum(values)/len(values), 3),
+                            'max_s': round(max(values), 3),
+                            'share': round(sum(values)/busy, 3)}
+        slowest = sorted(tiles, key=lambda k: sum(tiles[k][st] for st in self.stages), reverse=True)[:5]
+        summary = {'elapsed_s': round(elapsed, 3),
+                    'tiles': len(tiles),
+                    'pixels': pixels,
+                    'bytes': nbytes,
+                    'pixels_per_s': round(pixels/elapsed, 1) if elapsed else 0,
+                    'bytes_per_s': round(nbytes/elapsed, 1) if elapsed else 0,
+                    'retries': sum(t['retries'] for t in tiles.values()),
+                    'bottleneck': max(self.stages, key=lambda st: stages[st]['total_s']),
+                    'stages': stages,
+                    'slowest_tiles': slowest}
+        summary.update(extra)
+        summary['per_tile'] = tiles
+        return summary
+
+    def report(self, summary):
+        lines = ['{} tiles, {:,} pixels, {} in {}'.format(summary['tiles'], summary['pixels'],
+                human_size(summary['bytes']), human_time(summary['elapsed_s'])),
+                '{:,.0f} px/s, {}/s, {} retries'.format(summary['pixels_per_s'],
+                human_size(summary['bytes_per_s']), summary['retries'])]
+        for stage in self.stages:
+            st = summary['stages'][stage]
+            lines.append('{}: {:.1f} s total, {:.2f} s mean, {:.2f} s max ({:.0%})'.format(
+                        stage, st['total_s'], st['mean_s'], st['max_s'], st['share']))
+        lines.append('Slowest stage: {}'.format(summary['bottleneck']))
+        if 'block_cache' in summary:
+            bc = summary['block_cache']
+            lines.append('Block cache: {} hits, {} misses ({:.0%} hit rate), {} evicted'.format(
+                        bc['hits'], bc['misses'], bc['hit_rate'], bc['evicted']))
+        return '\n'.join(lines)
+
+    def save(self, path, summary):
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+def stats_path(save_path):
+    '''JSON sidecar written next to the geopackage'''
+    return '{}.stats.json'.format(os.path.splitext(save_path)[0])
+
+###---------------------Geopackage Writer Class----------------------------###
+def encode_tile(image, fmt='PNG', quality=-1):
+    '''Encode a QImage to bytes for storage in a tiles table'''
+    ba = QByteArray()
+    buf = QBuffer(ba)
+    buf.open(QIODevice.WriteOnly)
+    image.save(buf, fmt, quality)
+    buf.close()
+    return bytes(ba)
+
+
+class tileEncoder:
+    '''Encodes tiles for the tiles tables. fmt is PNG, JPEG, WEBP or AUTO:
+    JPEG for fully opaque tiles and PNG for tiles with transparency, which
+    the GeoPackage spec allows to be mixed in one table. Fully transparent
+    tiles are left out when drop_empty is set'''
+    formats = ['AUTO', 'PNG', 'JPEG', 'WEBP']
+    webp_extension = ('gpkg_webp', 'http://www.geopackage.org/spec/#extension_tiles_webp', 'read-write')
+
+    def __init__(self, fmt='PNG', quality=75, drop_empty=True):
+        fmt = fmt.upper()
+        if fmt not in self.formats:
+            raise ValueError('Unknown tile format: {}'.format(fmt))
+        if fmt == 'WEBP' and b'webp' not in QImageWriter.supportedImageFormats():
+            QgsMessageLog.logMessage('WebP is not supported by this Qt build, writing PNG tiles', level=Qgis.Warning)
+            fmt = 'PNG'
+        self.fmt = fmt
+        self.quality = max(1, min(100, int(quality)))
+        self.drop_empty = drop_empty
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(options.tile_format, options.tile_quality, options.drop_empty)
+
+    def alpha(self, image):
+        '''(fully transparent, fully opaque) for image'''
+        if not image.hasAlphaChannel():
+            return False, True
+        mask = image.convertToFormat(QImage.Format_Alpha8)
+        ptr = mask.constBits()
+        ptr.setsize(mask.sizeInBytes())
+        data = bytes(ptr)
+        return data.count(0) == len(data), data.count(255) == len(data)
+
+    def encode(self, image):
+        '''Bytes for one tile, or None if the tile should be left out'''
+        empty, opaque = self.alpha(image)
+        if empty and self.drop_empty:
+            return None
+        fmt = self.fmt
+        if fmt == 'AUTO':
+            fmt = 'JPEG' if opaque else 'PNG'
+        if fmt == 'PNG':
+            return encode_tile(image, 'PNG')
+        if fmt == 'JPEG' and not opaque:
+            # no alpha in jpeg, flatten onto white rather than black
+            flat = QImage(image.size(), QImage.Format_RGB32)
+            flat.fill(Qt.white)
+            painter = QPainter(flat)
+            painter.drawImage(0, 0, image)
+            painter.end()
+            image = flat
+        return encode_tile(image, fmt, self.quality)
+
+    def split(self, image, c0=0, r0=0):
+        '''Cut image into tiles and encode them. Returns a list of
+        (tile_column, tile_row, bytes) with tile (0, 0) of the image at
+        (c0, r0)'''
+        ts = gpkgTileWriter.tile_size
+        tiles = []
+        for r in range(math.ceil(image.height()/ts)):
+            for c in range(math.ceil(image.width()/ts)):
+                data = self.encode(image.copy(c*ts, r*ts, ts, ts))
+                if data is not None:
+                    tiles.append((c0+c, r0+r, data))
+        return tiles
+
+
+def composite_tile(below, above):
+    '''New image of tile above drawn over tile below'''
+    tile = below.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(tile)
+    painter.drawImage(0, 0, above)
+    painter.end()
+    return tile
+
+
+class tilePyramid:
+    '''Tile matrix set of the single table (pyramid) output. max_zoom has the
+    finest pixel size of the export, every level above it doubles the pixel
+    size, and the matrix at zoom z is 2^z tiles square, anchored at the top
+    left corner of the export extent'''
+    def __init__(self, extent, resolution, tile_size=256):
+        self.tile_size = tile_size
+        self.res = resolution
+        self.x0 = extent.xMinimum()
+        self.y0 = extent.yMaximum()
+        span = max(extent.width(), extent.height())/(tile_size*resolution)
+        self.max_zoom = max(0, math.ceil(math.log2(span)-1e-9)) if span > 1 else 0
+
+    @classmethod
+    def for_records(cls, records, tile_size=256):
+        '''Pyramid covering the planned cells, at the finest of their pixel sizes'''
+        extent = QgsRectangle(records[0]['extent'])
+        for r in records[1:]:
+            extent.combineExtentWith(r['extent'])
+        res = min(r['extent'].width()/r['cols'] for r in records if r['cols'] > 0)
+        return cls(extent, res, tile_size)
+
+    def resolution(self, zoom):
+        return self.res*2**(self.max_zoom-zoom)
+
+    def zoom_for(self, res):
+        '''Zoom level whose pixel size is nearest to res on a log scale'''
+        z = self.max_zoom-round(math.log2(res/self.res))
+        return max(0, min(self.max_zoom, z))
+
+    def matrix_extent(self):
+        size = 2**self.max_zoom*self.tile_size*self.res
+        return QgsRectangle(self.x0, self.y0-size, self.x0+size, self.y0)
+
+    def tile_range(self, rect, zoom):
+        '''(first column, first row, last column, last row) of the tiles at
+        zoom covering rect'''
+        span = self.tile_size*self.resolution(zoom)
+        last = 2**zoom-1
+        eps = 1e-9
+        c0 = math.floor((rect.xMinimum()-self.x0)/span+eps)
+        c1 = math.ceil((rect.xMaximum()-self.x0)/span-eps)-1
+        r0 = math.floor((self.y0-rect.yMaximum())/span+eps)
+        r1 = math.ceil((self.y0-rect.yMinimum())/span-eps)-1
+        return (max(0, min(c0, last)), max(0, min(r0, last)),
+                max(0, min(max(c0, c1), last)), max(0, min(max(r0, r1), last)))
+
+    def tiles_extent(self, zoom, c0, r0, c1, r1):
+        span = self.tile_size*self.resolution(zoom)
+        return QgsRectangle(self.x0+c0*span, self.y0-(r1+1)*span, self.x0+(c1+1)*span, self.y0-r0*span)
+
+
+class gpkgTileWriter:
+    '''Writes rendered blocks into a geopackage as GeoPackage tiles tables.
+    A single sqlite connection is kept open for the whole export and tables
+    are committed in batches of batch_size. The database runs in WAL mode
+    while writing and is switched back to a single file on close'''
+    tile_size = 256
+    application_id = 0x47504B47# 'GPKG'
+    user_version = 10200
+    core_tables = [
+        '''CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL,
+        srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL,
+        organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY,
+        data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '',
+        last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+        min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+        CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id))''',
+        '''CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (table_name TEXT NOT NULL,
+        column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL,
+        z TINYINT NOT NULL, m TINYINT NOT NULL,
+        CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+        CONSTRAINT uk_gc_table_name UNIQUE (table_name),
+        CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+        CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id))''',
+        '''CREATE TABLE IF NOT EXISTS gpkg_tile_matrix_set (table_name TEXT NOT NULL PRIMARY KEY,
+        srs_id INTEGER NOT NULL, min_x DOUBLE NOT NULL, min_y DOUBLE NOT NULL,
+        max_x DOUBLE NOT NULL, max_y DOUBLE NOT NULL,
+        CONSTRAINT fk_gtms_table_name FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+        CONSTRAINT fk_gtms_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id))''',
+        '''CREATE TABLE IF NOT EXISTS gpkg_tile_matrix (table_name TEXT NOT NULL,
+        zoom_level INTEGER NOT NULL, matrix_width INTEGER NOT NULL, matrix_height INTEGER NOT NULL,
+        tile_width INTEGER NOT NULL, tile_height INTEGER NOT NULL,
+        pixel_x_size DOUBLE NOT NULL, pixel_y_size DOUBLE NOT NULL,
+        CONSTRAINT pk_ttm PRIMARY KEY (table_name, zoom_level),
+        CONSTRAINT fk_tmm_table_name FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name))''',
+        '''CREATE TABLE IF NOT EXISTS gpkg_extensions (table_name TEXT, column_name TEXT,
+        extension_name TEXT NOT NULL, definition TEXT NOT NULL, scope TEXT NOT NULL,
+        CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))''']
+    default_srs = [
+        ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+        ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+        ('WGS 84 geodetic', 4326, 'EPSG', 4326,
+        'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'
+        'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+        'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AXIS["Latitude",NORTH],'
+        'AXIS["Longitude",EAST],AUTHORITY["EPSG","4326"]]',
+        'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid')]
+
+    manifest_table = 'basemap2gpkg_manifest'
+
+    def __init__(self, path, batch_size=25, encoder=None):
+        self.path = path
+        self.batch_size = max(1, int(batch_size))
+        self.encoder = encoder if encoder is not None else tileEncoder()
+        self.conn = None
+        self.uncommitted = []
+        self.srs_ids = {}
+        # write seconds and bytes of the last write_tiles call
+        self.timing = {'write': 0.0, 'bytes': 0}
+
+    def open(self):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        # isolation_level=None: transactions are managed explicitly below
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        self.conn.execute('PRAGMA cache_size=-65536')
+        if new_file:
+            self.conn.execute('PRAGMA application_id={}'.format(self.application_id))
+            self.conn.execute('PRAGMA user_version={}'.format(self.user_version))
+        self.conn.execute('BEGIN')
+        for sql in self.core_tables:
+            self.conn.execute(sql)
+        self.conn.executemany('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', self.default_srs)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS {} (table_name TEXT NOT NULL PRIMARY KEY,
+                cell INTEGER, min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                pixel_size DOUBLE, cols INTEGER, rows INTEGER, crs TEXT, source TEXT,
+                status TEXT NOT NULL,
+                updated DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), probe TEXT)'''.format(self.manifest_table))
+        # exports made before probes were stored
+        columns = [r[1] for r in self.conn.execute('PRAGMA table_info({})'.format(self.manifest_table))]
+        if 'probe' not in columns:
+            self.conn.execute('ALTER TABLE {} ADD COLUMN probe TEXT'.format(self.manifest_table))
+        self.recover()
+        self.conn.execute('COMMIT')
+        self.conn.execute('BEGIN')
+
+    def recover(self):
+        '''Remove metadata left behind for tile tables that no longer exist,
+        e.g. after an export was killed while another tool was writing'''
+        existing = [r[0] for r in self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        orphans = [r[0] for r in self.conn.execute("SELECT table_name FROM gpkg_contents WHERE data_type='tiles'")
+                    if r[0] not in existing]
+        for name in orphans:
+            self.delete_metadata(name)
+        if orphans:
+            QgsMessageLog.logMessage('Removed {} incomplete tables from {}'.format(len(orphans), self.path),
+                                    level=Qgis.Warning)
+
+    def read_manifest(self):
+        '''Return the manifest rows as a dict keyed by table name'''
+        cur = self.conn.execute('SELECT * FROM {}'.format(self.manifest_table))
+        fields = [d[0] for d in cur.description]
+        return {r[0]: dict(zip(fields, r)) for r in cur}
+
+    def record(self, name, record, status):
+        '''Add or update the manifest row of a table. record holds the cell
+        index, extent, pixel size, dimensions, crs authid, source and
+        optionally the probe hash of the source content'''
+        extent = record['extent']
+        self.conn.execute('''INSERT OR REPLACE INTO {} (table_name, cell, min_x, min_y, max_x, max_y,
+                pixel_size, cols, rows, crs, source, status, probe) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(self.manifest_table),
+                (name, record['cell'], extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(),
+                record['pixel_size'], record['cols'], record['rows'], record['crs'], record['source'], status,
+                record.get('probe') if status == 'complete' else None))
+
+    def has_table(self, name):
+        '''Tables are created in the same savepoint that marks them complete,
+        so an existing table holds every tile that was not empty'''
+        return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
+
+    def delete_metadata(self, name):
+        for tbl in ['gpkg_tile_matrix', 'gpkg_tile_matrix_set', 'gpkg_extensions', 'gpkg_contents']:
+            self.conn.execute('DELETE FROM {} WHERE table_name=?'.format(tbl), (name,))
+
+    def drop_table(self, name):
+        self.delete_metadata(name)
+        self.conn.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+
+    def srs_id(self, crs):
+        '''Return the gpkg_spatial_ref_sys id for crs, adding a row if needed'''
+        authid = crs.authid()
+        if authid in self.srs_ids:
+            return self.srs_ids[authid]
+        definition = crs.toWkt()
+        if authid.upper().startswith('EPSG:'):
+            srs_id = int(authid.split(':')[1])
+            org = 'EPSG'
+            org_id = srs_id
+        else:
+            row = self.conn.execute('SELECT srs_id FROM gpkg_spatial_ref_sys WHERE definition=?', (definition,)).fetchone()
+            srs_id = row[0] if row else max(100000, self.conn.execute(
+                        'SELECT MAX(srs_id) FROM gpkg_spatial_ref_sys').fetchone()[0] + 1)
+            org = 'NONE'
+            org_id = srs_id
+        self.conn.execute('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                        (crs.description(), srs_id, org, org_id, definition, crs.description()))
+        self.srs_ids[authid] = srs_id
+        return srs_id
+
+    def create_table(self, name, extent, crs, cols, rows):
+        '''Create (or replace) a tiles table for a raster of cols x rows pixels
+        covering extent. Returns the zoom level of the full resolution tiles.
+        The tile matrix set is padded to a power of two number of tiles so
+        overview levels each cover it with whole tiles'''
+        self.drop_table(name)
+        ts = self.tile_size
+        res_x = extent.width()/cols
+        res_y = extent.height()/rows
+        zoom = max(0, math.ceil(math.log2(max(math.ceil(cols/ts), math.ceil(rows/ts)))))
+        n = 2**zoom
+        self.add_tiles_table(name, extent, crs, QgsRectangle(extent.xMinimum(), extent.yMaximum()-n*ts*res_y,
+                                                        extent.xMinimum()+n*ts*res_x, extent.yMaximum()))
+        self.add_zoom_level(name, zoom, res_x, res_y)
+        return zoom
+
+    def create_pyramid(self, name, pyramid, extent, crs, replace=True):
+        '''Create the tiles table of a tilePyramid with all of its zoom
+        levels. With replace=False an existing table with the same tile
+        matrix is kept, e.g. when resuming. Returns True if the table was
+        (re)created'''
+        matrix = pyramid.matrix_extent()
+        if not replace:
+            row = self.conn.execute('''SELECT s.min_x, s.max_y, s.max_x, m.pixel_x_size FROM gpkg_tile_matrix_set s
+                    JOIN gpkg_tile_matrix m ON m.table_name=s.table_name AND m.zoom_level=?
+                    WHERE s.table_name=?''', (pyramid.max_zoom, name)).fetchone()
+            tol = matrix.width()*1e-9
+            if (row is not None and abs(row[0]-matrix.xMinimum()) <= tol and abs(row[1]-matrix.yMaximum()) <= tol
+                    and abs(row[2]-matrix.xMaximum()) <= tol and abs(row[3]-pyramid.res) <= pyramid.res*1e-9):
+                return False
+        self.drop_table(name)
+        self.add_tiles_table(name, extent, crs, matrix)
+        for z in range(pyramid.max_zoom+1):
+            self.add_zoom_level(name, z, pyramid.resolution(z), pyramid.resolution(z))
+        return True
+
+    def add_tiles_table(self, name, extent, crs, matrix):
+        srs_id = self.srs_id(crs)
+        self.conn.execute('''CREATE TABLE "{}" (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL,
+                tile_data BLOB NOT NULL, UNIQUE (zoom_level, tile_column, tile_row))'''.format(name))
+        self.conn.execute('''INSERT INTO gpkg_contents (table_name, data_type, identifier,
+                min_x, min_y, max_x, max_y, srs_id) VALUES (?, 'tiles', ?, ?, ?, ?, ?, ?)''',
+                (name, name, extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(), srs_id))
+        self.conn.execute('INSERT INTO gpkg_tile_matrix_set VALUES (?, ?, ?, ?, ?, ?)',
+                (name, srs_id, matrix.xMinimum(), matrix.yMinimum(), matrix.xMaximum(), matrix.yMaximum()))
+        if self.encoder.fmt == 'WEBP':
+            self.conn.execute('INSERT OR IGNORE INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)',
+                            (name, 'tile_data')+tileEncoder.webp_extension)
+
+    def add_zoom_level(self, name, zoom, res_x, res_y):
+        n = 2**zoom
+        self.conn.execute('INSERT OR REPLACE INTO gpkg_tile_matrix VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, zoom, n, n, self.tile_size, self.tile_size, res_x, res_y))
+
+    def insert_tiles(self, name, zoom, tiles):
+        '''tiles is an iterable of (tile_column, tile_row, encoded bytes)'''
+        self.conn.executemany('''INSERT OR REPLACE INTO "{}" (zoom_level, tile_column, tile_row, tile_data)
+                VALUES ({}, ?, ?, ?)'''.format(name, int(zoom)), tiles)
+
+    def write_overview(self, name, zoom, res_x, res_y, tiles):
+        '''Add tiles for an overview zoom level of an existing table'''
+        self.add_zoom_level(name, zoom, res_x, res_y)
+        self.insert_tiles(name, zoom, tiles)
+
+    def zoom_levels(self, name):
+        return [r[0] for r in self.conn.execute('SELECT zoom_level FROM gpkg_tile_matrix WHERE table_name=?', (name,))]
+
+    def write_tiles(self, name, zoom, tiles, record=None):
+        '''Add encoded tiles (see tileEncoder.split) to an existing tiles table.
+        Tiles already stored, where neighbouring cells of a pyramid share a
+        tile, are composited with the new tile drawn over the old one. A
+        manifest record is marked complete under record['table'] in the same
+        transaction and counts towards the batch. Returns the names of any
+        records committed as a result'''
+        t0 = time.time()
+        if tiles:
+            cs = [t[0] for t in tiles]
+            rs = [t[1] for t in tiles]
+            stored = {(c, r): data for c, r, data in self.conn.execute('''SELECT tile_column, tile_row, tile_data
+                    FROM "{}" WHERE zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?'''.format(name),
+                    (zoom, min(cs), max(cs), min(rs), max(rs)))}
+            if stored:
+                tiles = [(c, r, self.encoder.encode(composite_tile(QImage.fromData(stored[(c, r)]), QImage.fromData(data))))
+                        if (c, r) in stored else (c, r, data) for c, r, data in tiles]
+        self.conn.execute('SAVEPOINT tile_table')
+        try:
+            self.insert_tiles(name, zoom, tiles)
+            if record is not None:
+                self.record(record['table'], record, 'complete')
+        except Exception:
+            self.conn.execute('ROLLBACK TO tile_table')
+            self.conn.execute('RELEASE tile_table')
+            raise
+        self.conn.execute('RELEASE tile_table')
+        self.timing = {'write': time.time()-t0, 'bytes': sum(len(t[2]) for t in tiles)}
+        return self.written(record['table']) if record is not None else []
+
+    def written(self, name):
+        '''Count a write towards the current batch, committing when it is full'''
+        self.uncommitted.append(name)
+        if len(self.uncommitted) >= self.batch_size:
+            return self.commit()
+        return []
+
+    def commit(self):
+        self.conn.execute('COMMIT')
+        self.conn.execute('BEGIN')
+        committed = self.uncommitted
+        self.uncommitted = []
+        return committed
+
+    def close(self):
+        '''Commit outstanding tables and fold the WAL back into the .gpkg'''
+        if self.conn is None:
+            return []
+        try:
+            committed = self.commit()
+            self.conn.execute('COMMIT')
+            try:
+                self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                self.conn.execute('PRAGMA journal_mode=DELETE')
+            except sqlite3.OperationalError as e:
+                # Another connection still has the file open. The data is
+                # committed, the WAL is folded in when the file is next opened
+                QgsMessageLog.logMessage('Could not checkpoint {}: {}'.format(self.path, e), level=Qgis.Warning)
+        finally:
+            self.conn.close()
+            self.conn = None
+        return committed
+
+###---------------------Response Cache Classes-----------------------------###
+def cache_path():
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'basemap_2_geopackage', 'cache.db')
+
+
+class responseCache:
+    '''On disk cache of source blocks shared by all exports. Entries are
+    keyed by source uri, request extent and size, expire after ttl seconds
+    and the least recently used entries are evicted once the cache grows
+    past max_bytes. Safe to use from several download threads'''
+    def __init__(self, path, max_bytes, ttl, offline=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS blocks (key TEXT NOT NULL PRIMARY KEY,
+                source TEXT, created REAL NOT NULL, accessed REAL NOT NULL,
+                size INTEGER NOT NULL, data BLOB NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS blocks_accessed ON blocks (accessed)')
+        self.conn.execute('DELETE FROM blocks WHERE created < ?', (time.time()-self.ttl,))
+        self.total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM blocks').fetchone()[0]
+
+    @staticmethod
+    def key(uri, band, rect, width, height):
+        txt = '{}|{}|{:.9g},{:.9g},{:.9g},{:.9g}|{}x{}'.format(uri, band, rect.xMinimum(), rect.yMinimum(),
+                                                        rect.xMaximum(), rect.yMaximum(), width, height)
+        return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT created, data FROM blocks WHERE key=?', (key,)).fetchone()
+            if row is None or row[0] < now-self.ttl:
+                if row is not None:
+                    self.conn.execute('DELETE FROM blocks WHERE key=?', (key,))
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE blocks SET accessed=? WHERE key=?', (now, key))
+            self.hits += 1
+            return row[1]
+
+    def put(self, key, uri, data):
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute('SELECT size FROM blocks WHERE key=?', (key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, uri, now, now, len(data), data))
+            self.total += len(data)-(old[0] if old else 0)
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        '''Drop least recently used entries until the cache is back under
+        90% of its size cap'''
+        target = self.max_bytes*0.9
+        freed = 0
+        self.conn.execute('BEGIN')
+        for key, size in self.conn.execute('SELECT key, size FROM blocks ORDER BY accessed').fetchall():
+            if self.total-freed <= target:
+                break
+            self.conn.execute('DELETE FROM blocks WHERE key=?', (key,))
+            freed += size
+        self.conn.execute('COMMIT')
+        self.total -= freed
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class requestBudget:
+    '''Server requests in flight over all the exports run by an
+    exportQueue, at most max_active at once (0 for no limit). While several
+    exports are waiting for a slot each gets an equal share of the budget,
+    rounded up, so one large job can't hold every slot while the jobs
+    queued with it wait. A share an export isn't using is free for the
+    others. Thread safe'''
+    def __init__(self, max_active=0):
+        self.max_active = max(0, int(max_active))
+        self.cond = threading.Condition()
+        self.active = collections.Counter()
+        self.waiting = collections.Counter()
+
+    def set_limit(self, max_active):
+        with self.cond:
+            self.max_active = max(0, int(max_active))
+            self.cond.notify_all()
+
+    def share(self):
+        '''Slots each export asking for requests may hold at the moment'''
+        owners = set(self.active) | set(self.waiting)
+        return int(math.ceil(self.max_active/max(1, len(owners))))
+
+    def acquire(self, owner, feedback=None):
+        '''Wait for a slot for owner (the export). Returns False if feedback
+        was cancelled first'''
+        with self.cond:
+            self.waiting[owner] += 1
+            try:
+                while self.max_active > 0 and (sum(self.active.values()) >= self.max_active or
+                                                self.active[owner] >= self.share()):
+                    if feedback is not None and feedback.isCanceled():
+                        return False
+                    self.cond.wait(0.1)
+                self.active[owner] += 1
+                return True
+            finally:
+                self.waiting[owner] -= 1
+                if not self.waiting[owner]:
+                    del self.waiting[owner]
+
+    def release(self, owner):
+        with self.cond:
+            self.active[owner] -= 1
+            if not self.active[owner]:
+                del self.active[owner]
+            self.cond.notify_all()
+
+
+class requestScheduler:
+    '''Paces the server requests of all download threads of an export: at
+    most rate requests a second (0 for no limit) and max_active requests at
+    once (0 for no limit). A request that fails (an invalid block, or the
+    provider reporting an error such as HTTP 429/503) is retried up to
+    retries times, waiting backoff seconds doubled on each attempt with
+    some jitter. If budget is given, a requestBudget shared with other
+    exports, every request also takes one of its slots on behalf of owner.
+    Thread safe'''
+    def __init__(self, rate=0.0, max_active=0, retries=3, backoff=2.0, budget=None, owner=None):
+        self.interval = 1.0/rate if rate > 0 else 0.0
+        self.slots = threading.BoundedSemaphore(max_active) if max_active > 0 else None
+        self.budget = budget
+        self.owner = owner
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+        self.retried = 0
+        self.failed = 0
+
+    @staticmethod
+    def sleep(seconds, feedback=None):
+        '''Sleep, waking early if feedback is cancelled. Returns False if it was'''
+        end = time.time()+seconds
+        while time.time() < end:
+            if feedback is not None and feedback.isCanceled():
+                return False
+            time.sleep(max(0.0, min(0.1, end-time.time())))
+        return feedback is None or not feedback.isCanceled()
+
+    def wait_turn(self, feedback=None):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start+self.interval
+        return self.sleep(start-now, feedback)
+
+    def request(self, fetch, feedback=None):
+        '''Call fetch(), which returns (result, ok), until it succeeds or the
+        retries run out. Returns (result, ok, number of retries)'''
+        result, ok = None, False
+        for attempt in range(self.retries+1):
+            if attempt:
+                with self.lock:
+                    self.retried += 1
+                if not self.sleep(self.backoff*2**(attempt-1)*random.uniform(0.5, 1.5), feedback):
+                    break
+            if not self.wait_turn(feedback):
+                break
+            if self.slots is not None:
+                self.slots.acquire()
+            try:
+                if self.budget is not None and not self.budget.acquire(self.owner, feedback):
+                    break
+                try:
+                    result, ok = fetch()
+                finally:
+                    if self.budget is not None:
+                        self.budget.release(self.owner)
+            finally:
+                if self.slots is not None:
+                    self.slots.release()
+            if ok or (feedback is not None and feedback.isCanceled()):
+                return result, ok, attempt
+        with self.lock:
+            self.failed += 1
+        return result, False, self.retries
+
+
+class blockMemoryCache:
+    '''Decoded source blocks shared by the download threads of one export,
+    so the margins neighbouring cells need around their edges are read from
+    memory instead of the source. Least recently used blocks are dropped
+    once max_bytes is exceeded. A block being loaded by one thread is
+    waited for by the others rather than requested twice. Thread safe'''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.blocks = collections.OrderedDict()
+        self.loading = {}# key: threading.Event set once the load finishes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, key, load):
+        '''The block for key, calling load() on a miss. load returns a QImage,
+        or None for a failed read which is not kept'''
+        with self.lock:
+            img = self.lookup(key)
+            if img is not None:
+                return img
+            waiting = self.loading.get(key)
+            if waiting is None:
+                self.loading[key] = threading.Event()
+                self.misses += 1
+        if waiting is not None:
+            waiting.wait()
+            with self.lock:
+                img = self.lookup(key)
+            # the other thread's load failed, try again here
+            return img if img is not None else load()
+        img = None
+        try:
+            img = load()
+        finally:
+            with self.lock:
+                if img is not None and not img.isNull():
+                    self.put(key, img)
+                self.loading.pop(key).set()
+        return img
+
+    def lookup(self, key):
+        img = self.blocks.get(key)
+        if img is not None:
+            self.blocks.move_to_end(key)
+            self.hits += 1
+        return img
+
+    def put(self, key, img):
+        size = img.sizeInBytes()
+        if size > self.max_bytes:
+            return
+        self.blocks[key] = img
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old_key, old = self.blocks.popitem(last=False)
+            self.bytes -= old.sizeInBytes()
+            self.evicted += 1
+
+    def hit_rate(self):
+        total = self.hits+self.misses
+        return self.hits/total if total else 0.0
+
+    def summary(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evicted': self.evicted,
+                'hit_rate': round(self.hit_rate(), 3)}
+
+
+class sourceInterface(QgsRasterInterface):
+    '''Raster interface inserted between the provider and the projector of
+    a saveRasters pipe. It keeps count of the time spent waiting on the
+    source (fetch_time) so it can be told apart from reprojection.
+    With a responseCache, requests are split into blocks on a fixed grid in
+    the source crs, at a resolution snapped to the source's native
+    resolutions, so the same blocks are requested for an area whatever the
+    target crs or grid layout. Each block is read through the cache.
+    A blockMemoryCache shared by the pipes of an export is checked first,
+    and also turns on the block grid when the disk cache is off. With fresh
+    set the disk cache is written but not read, and bypass sends requests
+    straight to the provider.
+    Requests that reach the provider go through the requestScheduler if one
+    is given; failed is set once a request has used up its retries'''
+    block_size = 512
+
+    def __init__(self, input, uri, resolutions, cache=None, scheduler=None, memory=None):
+        QgsRasterInterface.__init__(self, input)
+        self.cache = cache
+        self.memory = memory
+        self.fresh = False
+        self.bypass = False
+        self.scheduler = scheduler
+        self.uri = uri
+        self.resolutions = sorted(resolutions)
+        self.fetch_time = 0.0
+        self.retries = 0
+        self.failed = False
+
+    def clone(self):
+        return sourceInterface(self.input().clone() if self.input() else None,
+                            self.uri, self.resolutions, self.cache, self.scheduler, self.memory)
+
+    def reset(self):
+        '''Clear the per cell counters'''
+        self.fetch_time = 0.0
+        self.retries = 0
+        self.failed = False
+
+    def fetch(self, band, rect, width, height, feedback):
+        '''Read from the provider. Returns the block and whether it came back
+        complete'''
+        def attempt():
+            errors = len(feedback.errors()) if feedback else 0
+            block = self.input().block(band, rect, width, height, feedback)
+            return block, block.isValid() and not (feedback and len(feedback.errors()) > errors)
+        t0 = time.time()
+        if self.scheduler is None:
+            block, ok = attempt()
+        else:
+            block, ok, retries = self.scheduler.request(attempt, feedback)
+            self.retries += retries
+            if block is None:
+                # cancelled before the first attempt, the pipe still needs a block
+                block = QgsRasterBlock()
+        self.fetch_time += time.time()-t0
+        if not ok and not (feedback and feedback.isCanceled()):
+            self.failed = True
+        return block, ok
+
+    def dataType(self, bandNo):
+        return self.input().dataType(bandNo) if self.input() else Qgis.UnknownDataType
+
+    def bandCount(self):
+        return self.input().bandCount() if self.input() else 0
+
+    def snap_resolution(self, res):
+        '''Largest native resolution no coarser than res. Sources without
+        native resolutions (plain WMS) snap to quarter powers of two'''
+        if self.resolutions:
+            finer = [r for r in self.resolutions if r <= res*(1+1e-9)]
+            return finer[-1] if finer else self.resolutions[0]
+        return 2**(math.floor(math.log2(res)*4)/4)
+
+    def fetch_block(self, band, col, row, res, feedback):
+        if self.memory is None:
+            return self.load_block(band, col, row, res, feedback)
+        loaded = []
+
+        def load():
+            loaded.append(time.time())
+            return self.load_block(band, col, row, res, feedback)
+
+        t0 = time.time()
+        img = self.memory.get((self.uri, band, res, col, row), load)
+        # Time spent waiting on another thread's load of the block counts
+        # too. A load run here has already added its own time
+        self.fetch_time += (loaded[0] if loaded else time.time())-t0
+        return img
+
+    def load_block(self, band, col, row, res, feedback):
+        span = self.block_size*res
+        rect = QgsRectangle(col*span, row*span, (col+1)*span, (row+1)*span)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.uri, band, rect, self.block_size, self.block_size)
+            t0 = time.time()
+            data = self.cache.get(key) if not self.fresh else None
+            self.fetch_time += time.time()-t0
+            if data is not None:
+                return QImage.fromData(data)
+            if self.cache.offline:
+                # the cell is incomplete: it is recorded as failed so a later
+                # resume, online, fills it in
+                self.failed = True
+                return None
+        block, ok = self.fetch(band, rect, self.block_size, self.block_size, feedback)
+        if not ok or (feedback and feedback.isCanceled()):
+            # Never cache a failed or partial response
+            return None
+        img = block.image()
+        if key is not None:
+            self.cache.put(key, self.uri, encode_tile(img))
+        return img
+
+    def block(self, bandNo, extent, width, height, feedback=None):
+        if self.input() is None or width <= 0 or height <= 0:
+            return QgsRasterBlock()
+        if (self.cache is None and self.memory is None) or self.bypass:
+            return self.fetch(bandNo, extent, width, height, feedback)[0]
+        bs = self.block_size
+        res = self.snap_resolution(min(extent.width()/width, extent.height()/height))
+        span = bs*res
+        c0 = math.floor(extent.xMinimum()/span)
+        c1 = max(c0, math.ceil(extent.xMaximum()/span)-1)
+        r0 = math.floor(extent.yMinimum()/span)
+        r1 = max(r0, math.ceil(extent.yMaximum()/span)-1)
+        mosaic = QImage((c1-c0+1)*bs, (r1-r0+1)*bs, QImage.Format_ARGB32_Premultiplied)
+        mosaic.fill(Qt.transparent)
+        painter = QPainter(mosaic)
+        for r in range(r0, r1+1):
+            for c in range(c0, c1+1):
+                if feedback and feedback.isCanceled():
+                    break
+                img = self.fetch_block(bandNo, c, r, res, feedback)
+                if img is not None and not img.isNull():
+                    painter.drawImage((c-c0)*bs, (r1-r)*bs, img)
+        painter.end()
+        # Resample the part of the mosaic covering the requested extent
+        src = QRectF((extent.xMinimum()-c0*span)/res, ((r1+1)*span-extent.yMaximum())/res,
+                    extent.width()/res, extent.height()/res)
+        out = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+        out.fill(Qt.transparent)
+        painter = QPainter(out)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(QRectF(0, 0, width, height), mosaic, src)
+        painter.end()
+        block = QgsRasterBlock(Qgis.ARGB32_Premultiplied, width, height)
+        block.setData(QByteArray(out.constBits().asstring(out.sizeInBytes())))
+        return block
+
+###---------------------Overview Builder Class-----------------------------###
+def overview_factors(levels):
+    '''Parse an overview levels string such as '2 4 8 16'. Only powers of
+    two can be stored as geopackage zoom levels, anything else is skipped'''
+    factors = set()
+    for item in levels.replace(',', ' ').split():
+        try:
+            f = int(item)
+        except ValueError:
+            f = 0
+        if f > 1 and f & (f-1) == 0:
+            factors.add(f)
+        else:
+            QgsMessageLog.logMessage('Ignoring overview level {}'.format(item), level=Qgis.Warning)
+    return sorted(factors)
+
+
+class overviewBuilder(threading.Thread):
+    '''Builds overview zoom levels for tile tables once they have been
+    committed, while the download carries on. Full resolution tiles are read
+    through a separate connection and every level of a table is produced in
+    one depth first pass, so each tile is read once and only a few images are
+    held in memory. Finished tiles are handed back through results for the
+    writer to insert.
+    With pyramid=True (single table output) every zoom level above the
+    finest one is filled in, and tiles already stored at a coarser level
+    (cells exported at a lower resolution) are kept on top of the tiles
+    built from the finer levels'''
+    chunk = 64
+
+    def __init__(self, path, factors, resampling='average', stats=None, pyramid=False, encoder=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.stats = stats
+        self.encoder = encoder if encoder is not None else tileEncoder()
+        self.factors = factors
+        self.pyramid = pyramid
+        self.transform = Qt.FastTransformation if resampling == 'nearest' else Qt.SmoothTransformation
+        self.tables = queue.Queue()
+        self.results = queue.Queue(maxsize=16)
+        self.canceled = False
+        self.waited = 0.0# seconds spent waiting for the writer to take results
+
+    def add(self, names):
+        for name in names:
+            self.tables.put(name)
+
+    def finish(self):
+        '''No more tables will be added'''
+        self.tables.put(None)
+
+    def cancel(self):
+        self.canceled = True
+        self.tables.put(None)
+
+    def emit(self, item):
+        t0 = time.time()
+        try:
+            while not self.canceled:
+                try:
+                    self.results.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+        finally:
+            self.waited += time.time()-t0
+
+    def run(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            while not self.canceled:
+                name = self.tables.get()
+                if name is None:
+                    break
+                try:
+                    t0 = time.time()
+                    waited = self.waited
+                    self.build(conn, name)
+                    if self.stats is not None:
+                        # time blocked on the writer is counted by it as overview_write
+                        self.stats.add(name, 'overviews', time.time()-t0-(self.waited-waited))
+                except Exception as e:
+                    QgsMessageLog.logMessage('Overviews for {} failed: {}'.format(name, e), level=Qgis.Warning)
+        finally:
+            conn.close()
+            self.emit(None)
+
+    def build(self, conn, name):
+        base, res_x, res_y = conn.execute('''SELECT zoom_level, pixel_x_size, pixel_y_size FROM gpkg_tile_matrix
+                WHERE table_name=? ORDER BY zoom_level DESC LIMIT 1''', (name,)).fetchone()
+        if self.pyramid:
+            levels = list(range(base))
+            native = set(conn.execute('SELECT zoom_level, tile_column, tile_row FROM "{}"'.format(name)))
+        else:
+            levels = [base-int(math.log2(f)) for f in self.factors if base-int(math.log2(f)) >= 0]
+            native = set((base, c, r) for c, r in conn.execute(
+                        'SELECT tile_column, tile_row FROM "{}" WHERE zoom_level=?'.format(name), (base,)))
+        if not levels:
+            return
+        # Positions at each level with any stored tile below them, so empty
+        # parts of a sparse matrix are skipped rather than walked
+        occupied = collections.defaultdict(set)
+        for z0, c0, r0 in native:
+            for z in range(min(levels), z0+1):
+                occupied[z].add((c0 >> (z0-z), r0 >> (z0-z)))
+        output = {z: [] for z in levels}
+        ts = gpkgTileWriter.tile_size
+
+        def stored(z, c, r):
+            return conn.execute('''SELECT tile_data FROM "{}" WHERE zoom_level=? AND tile_column=?
+                    AND tile_row=?'''.format(name), (z, c, r)).fetchone()[0]
+
+        def flush(z):
+            f = 2**(base-z)
+            self.emit((name, z, res_x*f, res_y*f, output[z]))
+            output[z] = []
+
+        def render(z, c, r):
+            if self.canceled or (c, r) not in occupied[z]:
+                return None
+            if z == base:
+                return QImage.fromData(stored(z, c, r))
+            canvas = None
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    child = render(z+1, 2*c+dx, 2*r+dy)
+                    if child is None or child.isNull():
+                        continue
+                    if canvas is None:
+                        canvas = QImage(2*ts, 2*ts, QImage.Format_ARGB32_Premultiplied)
+                        canvas.fill(Qt.transparent)
+                    painter = QPainter(canvas)
+                    painter.drawImage(dx*ts, dy*ts, child)
+                    painter.end()
+            kept = self.pyramid and (z, c, r) in native
+            if canvas is None:
+                return QImage.fromData(stored(z, c, r)) if kept else None
+            img = canvas.scaled(ts, ts, Qt.IgnoreAspectRatio, self.transform)
+            if kept:
+                # the stored tile stays on top, the built one fills in where it is transparent
+                img = composite_tile(img, QImage.fromData(stored(z, c, r)))
+            data = self.encoder.encode(img) if z in output else None
+            if data is not None:
+                output[z].append((c, r, data))
+                if len(output[z]) >= self.chunk:
+                    flush(z)
+            return img
+
+        top = min(levels)
+        for r in range(2**top):
+            for c in range(2**top):
+                render(top, c, r)
+        for z in levels:
+            if output[z]:
+                flush(z)
+
 ###---------------------Task Save Rasters Class-----------------------------###
+def source_id(layer):
+    '''Layer source string used to identify a basemap in the manifest,
+    with any password removed'''
+    parts = [p for p in layer.source().split('&') if not p.lower().startswith('password=')]
+    return '&'.join(parts)
+
+
+def table_prefixes(layers):
+    '''Table name prefix for each layer of a multi source export, made from
+    the layer names and kept unique'''
+    prefixes = []
+    for layer in layers:
+        base = re.sub('[^0-9a-zA-Z]+', '_', layer.name()).strip('_').lower() or 'basemap'
+        prefix = base
+        n = 1
+        while prefix in prefixes:
+            n += 1
+            prefix = '{}_{}'.format(base, n)
+        prefixes.append(prefix)
+    return prefixes
+
 class saveRasters(QgsTask):
     currentChanged = pyqtSignal(str)
     done = pyqtSignal(bool)
-    def __init__(self, desc, project, grid, source, save_path, crs, build_overviews):
+    def __init__(self, desc, project, grid, source, save_path, crs, build_overviews, options=None, grid_crs=None,
+                mask=None, budget=None):
+        '''grid is a list of [QgsRectangle, pixel size] cells in grid_crs
+        (the project crs if not given), pixel sizes in the crs of the
+        (first) source. source is a layer, or a list of layers exported over
+        the same grid in one pass: the cells are planned once, each source
+        gets its own tables named after the layer and the download threads
+        work through the cells of all sources together. mask is an optional
+        polygon geometry in grid_crs (other geometry types are ignored);
+        pixels outside it are left transparent and parts of cells entirely
+        outside it are not downloaded. budget is the requestBudget of the
+        exportQueue running the task, shared with the exports run with it'''
         QgsTask.__init__(self, desc, QgsTask.CanCancel)
 #        super().__init__(desc, QgsTask.CanCancel)#10-01-2024
         self.project = project
         self.grid = grid
-        self.source = source
+        self.grid_crs = grid_crs if grid_crs is not None else self.project.crs()
+        self.sources = list(source) if isinstance(source, (list, tuple)) else [source]
+        self.source = self.sources[0]
         self.save_path = save_path
         self.crs = crs
         self.build_overviews = build_overviews
-        self.feedback = QgsRasterBlockFeedback()
-        self.feedback.progressChanged.connect(lambda: self.setProgress(self.feedback.progress()))
-        self.xform1 = QgsCoordinateTransform(self.project.crs(), self.source.crs(), self.project)
-        self.xform2 = QgsCoordinateTransform(self.project.crs(), self.crs, self.project)
-        
-    def run(self):
-        provider = self.source.dataProvider()
+        self.options = options if options is not None else exportOptions()
+        self.workers = max(1, int(self.options.workers))
+        self.source_uris = [source_id(s) for s in self.sources]
+        self.source_uri = self.source_uris[0]
+        # a single source keeps the original image_tile table names
+        self.prefixes = table_prefixes(self.sources) if len(self.sources) > 1 else ['image']
+        self.planner = exportPlanner(self.grid_crs, self.source.crs(), self.crs, self.project)
+        # One provider clone per worker and source, created on the main thread
+        self.providers = [[s.dataProvider().clone() for i in range(self.workers)] for s in self.sources]
+        self.feedbacks = set()
+        self.pixels_done = 0
+        self.elapsed = 0
+        self.stats = exportStats()
+        self.encoder = tileEncoder.from_options(self.options)
+        # Rate limits apply per source, they are usually different servers
+        self.schedulers = [requestScheduler(self.options.rate_limit, self.options.max_requests,
+                                            self.options.retries, self.options.retry_backoff, budget, self)
+                            for s in self.sources]
+        self.failures = []
+        self.probe_lock = threading.Lock()
+        self.probed = set()# cells whose probe was taken or is being taken
+        budget = self.options.memory_budget_mb*1024*1024
+        # The block cache comes out of the memory budget, capped at half of it
+        cache_bytes = min(self.options.block_cache_mb*1024*1024, budget//2)
+        blocked = cache_bytes > 0 or self.options.cache or self.options.offline
+        self.part_size = self.fit_part_size(budget-cache_bytes, self.workers, blocked)
+        self.mask = None
+        if mask is not None and mask.type() == QgsWkbTypes.PolygonGeometry:
+            # Geometry work stays on the task thread: the parts are checked
+            # against the mask before they are handed to the workers
+            self.mask = QgsGeometry(mask)
+            if self.grid_crs != self.crs:
+                self.mask.transform(QgsCoordinateTransform(self.grid_crs, self.crs, self.project))
+            self.mask_engine = QgsGeometry.createGeometryEngine(self.mask.constGet())
+            self.mask_engine.prepareGeometry()
+        self.memory = None
+        if cache_bytes > 0:
+            self.memory = blockMemoryCache(cache_bytes)
+        self.cache = None
+        if self.options.cache or self.options.offline:
+            self.cache = responseCache(cache_path(),
+                                    self.options.cache_size_mb*1024*1024,
+                                    self.options.cache_ttl_days*86400,
+                                    self.options.offline)
+
+    @staticmethod
+    def fit_part_size(budget, workers, blocked):
+        '''Largest part of a cell rendered in one go, a whole number of tiles
+        square: every part in flight (two per worker) has to fit in budget
+        bytes with the copies made while reprojecting and encoding it. When
+        the source is read through the block grid the mosaic it is drawn
+        from counts too: up to twice as fine as the part on each side (the
+        resolution is snapped finer) and rounded out to whole blocks'''
+        ts = gpkgTileWriter.tile_size
+        bs = sourceInterface.block_size
+
+        def part_bytes(side):
+            mosaic = (2*side+2*bs)**2 if blocked else 0
+            return 4*(3*side*side+mosaic)
+
+        side = ts
+        while part_bytes(side+ts)*2*workers <= budget:
+            side += ts
+        return side
+
+    def make_pipe(self, k, provider):
+        '''Returns the pipe and the sourceInterface in it, for source k'''
         pipe = QgsRasterPipe()
-        pipe.set(provider.clone())
-        if self.source.crs() != self.crs:
+        pipe.set(provider)
+        source = sourceInterface(None, self.source_uris[k], provider.nativeResolutions(), self.cache,
+                                self.schedulers[k], self.memory)
+        # a refresh must not be served what an earlier export cached
+        source.fresh = self.options.refresh
+        pipe.insert(1, source)
+        if self.sources[k].crs() != self.crs:
+            # One projector per pipe, reused for every cell the pipe renders
             projector = QgsRasterProjector()
-            projector.setCrs(self.source.crs(), self.crs, self.project.transformContext())
+            projector.setCrs(self.sources[k].crs(), self.crs, self.project.transformContext())
+            projector.setPrecision(QgsRasterProjector.Approximate)
             pipe.insert(2, projector)
-        for current, rb in enumerate(self.grid):
-            #10-1-2024
-            if self.isCanceled():
+        return pipe, source
+
+    def already_saved(self, row, record):
+        '''Check a manifest row against a planned cell'''
+        if row is None or row['status'] != 'complete':
+            return False
+        extent = record['extent']
+        tol = max(extent.width(), extent.height())*1e-6
+        return (abs(row['min_x']-extent.xMinimum()) <= tol and
+                abs(row['min_y']-extent.yMinimum()) <= tol and
+                abs(row['max_x']-extent.xMaximum()) <= tol and
+                abs(row['max_y']-extent.yMaximum()) <= tol and
+                row['cols'] == record['cols'] and row['rows'] == record['rows'] and
+                row['pixel_size'] == record['pixel_size'] and
+                row['crs'] == record['crs'] and row['source'] == record['source'])
+
+    def pyramid_table(self, k):
+        if len(self.sources) == 1:
+            return self.options.pyramid_table
+        return '{}_{}'.format(self.options.pyramid_table, self.prefixes[k])
+
+    def plan_pyramid(self, writer, plan):
+        '''Map the planned cells onto the zoom levels of one tile pyramid per
+        source. Each cell is widened to whole tiles at the zoom level nearest
+        its pixel size. Returns True if a pyramid table was (re)created'''
+        if not plan:
+            return False
+        pyramid = tilePyramid.for_records(plan, gpkgTileWriter.tile_size)
+        extent = QgsRectangle(plan[0]['extent'])
+        for r in plan:
+            extent.combineExtentWith(r['extent'])
+            zoom = pyramid.zoom_for(r['extent'].width()/r['cols'])
+            c0, r0, c1, r1 = pyramid.tile_range(r['extent'], zoom)
+            r.update({'zoom': zoom,
+                    'tile_col': c0,
+                    'tile_row': r0,
+                    'extent': pyramid.tiles_extent(zoom, c0, r0, c1, r1),
+                    'cols': (c1-c0+1)*pyramid.tile_size,
+                    'rows': (r1-r0+1)*pyramid.tile_size})
+        created = False
+        for k in range(len(self.sources)):
+            created = writer.create_pyramid(self.pyramid_table(k), pyramid, extent, self.crs,
+                                            replace=not (self.options.resume or self.options.refresh)) or created
+        writer.commit()
+        return created
+
+    def source_records(self, plan, pyramid):
+        '''One record per cell and source, the sources of a cell next to each
+        other so they are fetched around the same time'''
+        records = []
+        for r in plan:
+            for k, prefix in enumerate(self.prefixes):
+                if pyramid:
+                    tiles = self.pyramid_table(k)
+                    table = '{}_cell{}'.format(tiles, r['cell']+1)
+                else:
+                    table = tiles = '{}_tile{}'.format(prefix, r['cell']+1)
+                records.append(dict(r, table=table, tiles=tiles, source=self.source_uris[k], source_index=k))
+        return records
+
+    def split_parts(self, record):
+        '''Split a cell into parts of at most part_size pixels square, on tile
+        boundaries, so no single request or block goes over the memory budget.
+        Most cells are a single part'''
+        ts = gpkgTileWriter.tile_size
+        extent = record['extent']
+        res_x = extent.width()/record['cols']
+        res_y = extent.height()/record['rows']
+        parts = []
+        for y in range(0, record['rows'], self.part_size):
+            for x in range(0, record['cols'], self.part_size):
+                w = min(self.part_size, record['cols']-x)
+                h = min(self.part_size, record['rows']-y)
+                parts.append({'record': record,
+                            'index': len(parts),
+                            'extent': QgsRectangle(extent.xMinimum()+x*res_x, extent.yMaximum()-(y+h)*res_y,
+                                                extent.xMinimum()+(x+w)*res_x, extent.yMaximum()-y*res_y),
+                            'cols': w,
+                            'rows': h,
+                            'tile_col': record.get('tile_col', 0)+x//ts,
+                            'tile_row': record.get('tile_row', 0)+y//ts})
+        return parts
+
+    def mask_part(self, part):
+        '''Where the mask falls on a part: 'outside', 'inside', or the rings
+        of the mask inside the part in pixel coordinates'''
+        extent = part['extent']
+        rect = QgsGeometry.fromRect(extent)
+        if not self.mask_engine.intersects(rect.constGet()):
+            return 'outside'
+        if self.mask_engine.contains(rect.constGet()):
+            return 'inside'
+        res_x = extent.width()/part['cols']
+        res_y = extent.height()/part['rows']
+        rings = []
+        for polygon in self.mask.clipped(extent).asGeometryCollection():
+            for ring in polygon.asPolygon():
+                rings.append([((p.x()-extent.xMinimum())/res_x, (extent.yMaximum()-p.y())/res_y) for p in ring])
+        return rings
+
+    @staticmethod
+    def apply_mask(image, rings):
+        '''Make the pixels of image outside rings transparent'''
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        path = QPainterPath()
+        path.setFillRule(Qt.OddEvenFill)# holes are rings inside rings
+        for ring in rings:
+            path.addPolygon(QPolygonF([QPointF(x, y) for x, y in ring]))
+        stencil = QImage(image.size(), QImage.Format_ARGB32_Premultiplied)
+        stencil.fill(Qt.transparent)
+        painter = QPainter(stencil)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.fillPath(path, QColor('Black'))
+        painter.end()
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_DestinationIn)
+        painter.drawImage(0, 0, stencil)
+        painter.end()
+        return image
+
+    def fetch_tile(self, pipes, part):
+        '''Runs in a worker thread. Borrows a free pipe and renders one part
+        of a cell'''
+        record = part['record']
+        tile_rect = part['extent']
+        if part.get('mask') == 'outside':
+            return part, True, []
+        feedback = QgsRasterBlockFeedback()
+        self.feedbacks.add(feedback)
+        pipe, source = pipes.get()
+        try:
+            source.reset()
+            t0 = time.time()
+            block = pipe.last().block(1, tile_rect, part['cols'], part['rows'], feedback)
+            total = time.time()-t0
+            failed = source.failed
+            self.stats.add(record['table'], 'fetch', source.fetch_time)
+            self.stats.add(record['table'], 'reproject', max(0.0, total-source.fetch_time))
+            self.stats.count(record['table'], 'retries', source.retries)
+        finally:
+            pipes.put((pipe, source))
+            self.feedbacks.discard(feedback)
+        if feedback.isCanceled():
+            return part, None, None
+        if failed or not block.isValid():
+            return part, False, None
+        if self.options.probe and 'probe' not in record and self.claim_probe(record):
+            part['probe'] = self.probe(pipes, record)
+        # Encode here rather than in the writer so compression runs in parallel
+        t0 = time.time()
+        image = block.image()
+        if part.get('mask', 'inside') != 'inside':
+            image = self.apply_mask(image, part['mask'])
+        tiles = self.encoder.split(image, part['tile_col'], part['tile_row'])
+        self.stats.add(record['table'], 'encode', time.time()-t0)
+        return part, True, tiles
+
+    def claim_probe(self, record):
+        '''True for the first part of a cell that is fetched, which takes the
+        probe. Not necessarily part 0: parts outside the mask are never fetched'''
+        with self.probe_lock:
+            if record['table'] in self.probed:
+                return False
+            self.probed.add(record['table'])
+            return True
+
+    def probe(self, pipes, record):
+        '''Runs in a worker thread. Hash of a small rendering of a cell made
+        straight from the server, skipping the caches. Stored in the manifest
+        so a later refresh can tell whether the source has changed. None if
+        the request failed'''
+        feedback = QgsRasterBlockFeedback()
+        self.feedbacks.add(feedback)
+        pipe, source = pipes.get()
+        try:
+            source.reset()
+            source.bypass = True
+            size = self.options.probe_size
+            block = pipe.last().block(1, record['extent'], size, size, feedback)
+            failed = source.failed
+        finally:
+            source.bypass = False
+            pipes.put((pipe, source))
+            self.feedbacks.discard(feedback)
+        if failed or feedback.isCanceled() or not block.isValid():
+            return None
+        return hashlib.sha1(block.data().data()).hexdigest()
+
+    def changed_records(self, pipes, records):
+        '''Probe the cells of an earlier export again. Returns the records
+        whose source content changed or that were saved without a probe, and
+        the number that could not be checked (those are left as they are).
+        Cells saved without a probe have nothing to compare with, they are
+        returned without asking the server'''
+        changed = [r for r in records if not r['stored_probe']]
+        records = [r for r in records if r['stored_probe']]
+        unchecked = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.probe, pipes[r['source_index']], r): r for r in records}
+            for done, f in enumerate(concurrent.futures.as_completed(futures)):
+                if self.isCanceled():
+                    for other in futures:
+                        other.cancel()
+                    self.cancel_fetches()
+                    break
+                r = futures[f]
+                probe = f.result()
+                if probe is None:
+                    unchecked += 1
+                elif probe != r['stored_probe']:
+                    r['probe'] = probe
+                    changed.append(r)
+                self.currentChanged.emit('Checked {}/{}'.format(done+1, len(records)))
+        return changed, unchecked
+
+    def cancel_fetches(self):
+        for feedback in list(self.feedbacks):
+            feedback.cancel()
+
+    @staticmethod
+    def stop_builder(builder, timeout=30):
+        '''Cancel the overview builder if it is still running and wait for it
+        to close its connection, so the writer can checkpoint the geopackage'''
+        if builder.is_alive():
+            builder.cancel()
+            builder.join(timeout)
+
+    def write_overviews(self, writer, builder, block=False):
+        '''Insert the overview tiles the builder has finished so far. With
+        block=True wait until the builder has worked through every table.
+        Returns False once the builder has stopped'''
+        while True:
+            try:
+                item = builder.results.get(timeout=0.5 if block else 0)
+            except queue.Empty:
+                if block and not self.isCanceled():
+                    continue
+                return True
+            if item is None:
                 return False
-            self.currentChanged.emit('{}/{}'.format(str(current+1), str(len(self.grid))))
-            #get extent of each grid rb and write to gpkg
-            tile_rect = rb[0].asGeometry().boundingBox()
-            pixel_size = rb[1]
-            ###################################################
-            cols = int(tile_rect.width()/pixel_size)
-            rows = int(tile_rect.height()/pixel_size)
-            if self.project.crs() != 'EPSG:3857':
-                extent_m = self.xform1.transform(tile_rect)
-                cols = int(extent_m.width()/pixel_size)
-                rows = int(extent_m.height()/pixel_size)
-            if self.project.crs() != self.crs:
-                tile_rect = self.xform2.transform(tile_rect)
-            #######################################
-            fw = QgsRasterFileWriter(self.save_path)
-            fw.setOutputFormat('gpkg')
-            tbl_name = 'image_tile{}'.format(str(current+1))
-            tbl = 'RASTER_TABLE={}'.format(tbl_name)
-            fw.setCreateOptions([tbl, 'APPEND_SUBDATASET=YES'])
-            err = fw.writeRaster(pipe,
-                                cols,
-                                rows,
-                                tile_rect,
-                                self.crs,
-                                feedback = self.feedback)
-                                
-            #TODO: Make sure path matches save file path!
-            if self.build_overviews:
-                if err == 0:
-                    path = 'GPKG:{}:image_tile{}'.format(self.save_path, current+1)
-                    input = QgsRasterLayer(path, 'tile', 'gdal')
-                    params = {'INPUT':input,
-                        'CLEAN':False,
-                        'LEVELS':'2 4 8 16',
-                        'RESAMPLING':1,
-                        'FORMAT':0,
-                        'EXTRA':''}
-                    processing.run("gdal:overviews", params)
-            del fw
+            t0 = time.time()
+            writer.write_overview(*item)
+            self.stats.add(item[0], 'overview_write', time.time()-t0)
+            self.stats.count(item[0], 'bytes', sum(len(t[2]) for t in item[4]))
+
+    def run(self):
+        start = time.time()
+        pipes = []
+        for k, providers in enumerate(self.providers):
+            pipes.append(queue.Queue())
+            for provider in providers:
+                pipes[k].put(self.make_pipe(k, provider))
+        writer = gpkgTileWriter(self.save_path, self.options.batch_size, self.encoder)
+        builder = None
+        try:
+            writer.open()
+            factors = overview_factors(self.options.overview_levels) if self.build_overviews else []
+            pyramid = self.options.output_mode == 'pyramid'
+            # a pyramid fills every coarser zoom level, whatever the levels setting
+            if factors or (pyramid and self.build_overviews):
+                builder = overviewBuilder(self.save_path, factors, self.options.overview_resampling, self.stats,
+                                        pyramid, self.encoder)
+            #get extent of each grid cell, shared by all sources
+            cells = []
+            for current, (cell, planned) in enumerate(zip(self.grid, self.planner.plan(self.grid))):
+                tile_rect, cols, rows = planned[1:]
+                cells.append({'cell': current,
+                            'extent': tile_rect,
+                            'cols': cols,
+                            'rows': rows,
+                            'pixel_size': cell[1],
+                            'crs': self.crs.authid()})
+            empty = [r for r in cells if r['cols'] <= 0 or r['rows'] <= 0]
+            if empty:
+                QgsMessageLog.logMessage('Skipping {} cells smaller than one pixel'.format(len(empty)), level=Qgis.Warning)
+                cells = [r for r in cells if r['cols'] > 0 and r['rows'] > 0]
+            created = False
+            if pyramid:
+                created = self.plan_pyramid(writer, cells)
+            plan = self.source_records(cells, pyramid)
+            if self.options.resume or self.options.refresh:
+                manifest = writer.read_manifest()
+                todo = [r for r in plan if not (self.already_saved(manifest.get(r['table']), r)
+                                                and writer.has_table(r['tiles'])) or created]
+                if self.options.refresh:
+                    names = set(r['table'] for r in todo)
+                    saved = [r for r in plan if r['table'] not in names]
+                    for r in saved:
+                        r['stored_probe'] = manifest[r['table']]['probe']
+                    self.currentChanged.emit('Checking {} tiles for changes'.format(len(saved)))
+                    changed, unchecked = self.changed_records(pipes, saved)
+                    if self.isCanceled():
+                        return False
+                    unprobed = sum(1 for r in saved if not r['stored_probe'])
+                    QgsMessageLog.logMessage('Refresh: {} of {} tiles changed, {} saved without a probe, '
+                                            '{} missing or incomplete{}'.format(
+                                            len(changed)-unprobed, len(saved)-unprobed, unprobed, len(todo),
+                                            ', {} could not be checked'.format(unchecked) if unchecked else ''),
+                                            level=Qgis.Info)
+                    names.update(r['table'] for r in changed)
+                    todo = [r for r in plan if r['table'] in names]
+                elif len(todo) < len(plan):
+                    QgsMessageLog.logMessage('Resuming export: {} of {} tiles already in {}'.format(
+                                            len(plan)-len(todo), len(plan), self.save_path), level=Qgis.Info)
+                if builder is not None and not pyramid:
+                    # Tables saved before the interruption may still be missing their overviews
+                    names = [r['table'] for r in todo]
+                    builder.add(r['table'] for r in plan if r['table'] not in names
+                                and len(writer.zoom_levels(r['table'])) < 2)
+            else:
+                todo = plan
+            # Mark everything still to do as pending so an interrupted run can be resumed
+            for r in todo:
+                writer.record(r['table'], r, 'pending')
+            writer.commit()
+            jobs = collections.deque(part for r in todo for part in self.split_parts(r))
+            if self.mask is not None:
+                # the parts of every source cover the same extents
+                masks = {}
+                for part in jobs:
+                    e = part['extent']
+                    key = (e.xMinimum(), e.yMinimum(), e.xMaximum(), e.yMaximum(), part['cols'], part['rows'])
+                    if key not in masks:
+                        masks[key] = self.mask_part(part)
+                    part['mask'] = masks[key]
+            parts_left = collections.Counter(part['record']['table'] for part in jobs)
+            if len(jobs) > len(todo):
+                QgsMessageLog.logMessage('Rendering {} cells in {} parts of up to {}px to stay within {} MB'.format(
+                                        len(todo), len(jobs), self.part_size, self.options.memory_budget_mb), level=Qgis.Info)
+            pending = set()
+            # Parts that failed after their retries get one more go at the end
+            retry_jobs = []
+            retried = set()
+            failed = set()
+            started = {}# zoom level of each table created so far
+            skipped = len(plan)-len(todo)
+            completed = skipped
+            parts_total = max(1, len(jobs))
+            parts_done = 0
+            self.setProgress(completed/max(1, len(plan))*100)
+            if builder is not None:
+                builder.start()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                while jobs or pending or retry_jobs:
+                    #10-1-2024
+                    if self.isCanceled():
+                        for f in pending:
+                            f.cancel()
+                        self.cancel_fetches()
+                        if builder is not None:
+                            self.stop_builder(builder)
+                        return False
+                    if not jobs and not pending:
+                        QgsMessageLog.logMessage('Retrying {} failed tiles'.format(len(retry_jobs)), level=Qgis.Info)
+                        self.currentChanged.emit('Retrying {} tiles'.format(len(retry_jobs)))
+                        jobs.extend(retry_jobs)
+                        retry_jobs = []
+                    # Keep a couple of parts queued per worker, no more, so finished
+                    # blocks don't pile up in memory while the writer catches up
+                    while jobs and len(pending) < self.workers*2:
+                        part = jobs.popleft()
+                        pending.add(pool.submit(self.fetch_tile, pipes[part['record']['source_index']], part))
+                    finished, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in finished:
+                        part, valid, tiles = f.result()
+                        if valid is None:
+                            continue
+                        r = part['record']
+                        if valid and part.get('probe'):
+                            r['probe'] = part['probe']
+                        if not valid and not self.options.offline and (r['table'], part['index']) not in retried:
+                            # Back of the queue, by then the server may have recovered
+                            retried.add((r['table'], part['index']))
+                            retry_jobs.append(part)
+                            continue
+                        parts_done += 1
+                        parts_left[r['table']] -= 1
+                        last = parts_left[r['table']] == 0
+                        #write to gpkg
+                        if not valid:
+                            if r['table'] not in failed:
+                                QgsMessageLog.logMessage('Failed to fetch {}'.format(r['table']), level=Qgis.Warning)
+                                writer.record(r['table'], r, 'failed')
+                                self.failures.append(r['table'])
+                                failed.add(r['table'])
+                        elif r['table'] not in failed:
+                            if pyramid:
+                                zoom = r['zoom']
+                            elif r['table'] not in started:
+                                zoom = started[r['table']] = writer.create_table(r['table'], r['extent'], self.crs,
+                                                                                r['cols'], r['rows'])
+                            else:
+                                zoom = started[r['table']]
+                            # The manifest row is only marked complete with the last part
+                            committed = writer.write_tiles(r['tiles'], zoom, tiles, r if last else None)
+                            self.pixels_done += part['cols']*part['rows']
+                            self.stats.add(r['table'], 'write', writer.timing['write'])
+                            self.stats.count(r['table'], 'bytes', writer.timing['bytes'])
+                            self.stats.count(r['table'], 'pixels', part['cols']*part['rows'])
+                            if builder is not None and not pyramid:
+                                builder.add(committed)
+                        if last:
+                            completed += 1
+                            self.currentChanged.emit('{}/{}'.format(str(completed), str(len(plan))))
+                        self.setProgress((skipped+parts_done/parts_total*len(todo))/len(plan)*100)
+                    if builder is not None:
+                        self.write_overviews(writer, builder)
+            if builder is not None:
+                # Hand over the last batch and wait for the overview stage to finish
+                committed = writer.commit()
+                builder.add([self.pyramid_table(k) for k in range(len(self.sources))] if pyramid else committed)
+                builder.finish()
+                self.currentChanged.emit('Building overviews')
+                self.write_overviews(writer, builder, block=True)
+                if self.isCanceled():
+                    self.stop_builder(builder)
+                    return False
+        finally:
+            # Tables that were written completely are kept, even when the
+            # task is cancelled, so nothing already downloaded is lost
+            if builder is not None:
+                self.stop_builder(builder)
+            try:
+                writer.close()
+            finally:
+                self.elapsed = time.time()-start
+                self.report_stats()
+        if self.failures:
+            QgsMessageLog.logMessage('{} tiles could not be fetched: {}. Run the export again with resume to fill them in'.format(
+                                    len(self.failures), ', '.join(self.failures)), level=Qgis.Warning)
+        if self.cache is not None:
+            QgsMessageLog.logMessage('Response cache: {} hits, {} misses'.format(self.cache.hits, self.cache.misses),
+                                    level=Qgis.Info)
+            if self.options.offline and self.cache.misses:
+                QgsMessageLog.logMessage('Offline mode: {} blocks were not in the cache, the tiles needing them are '
+                                        'marked failed'.format(self.cache.misses), level=Qgis.Warning)
         return True
-        
+
+    def report_stats(self):
+        '''Write the timing summary to the QGIS log and a JSON sidecar file'''
+        self.stats.stop()
+        extra = {'source': self.source_uri if len(self.sources) == 1 else self.source_uris,
+                'output': self.save_path,
+                'crs': self.crs.authid(),
+                'workers': self.workers,
+                'canceled': self.isCanceled(),
+                'failed': self.failures,
+                'requests_failed': sum(s.failed for s in self.schedulers)}
+        if self.cache is not None:
+            extra['cache'] = {'hits': self.cache.hits, 'misses': self.cache.misses}
+        if self.memory is not None:
+            extra['block_cache'] = self.memory.summary()
+        summary = self.stats.summary(**extra)
+        QgsMessageLog.logMessage('Export statistics for {}\n{}'.format(self.save_path, self.stats.report(summary)),
+                                level=Qgis.Info)
+        try:
+            self.stats.save(stats_path(self.save_path), summary)
+        except OSError as e:
+            QgsMessageLog.logMessage('Could not write export statistics: {}'.format(e), level=Qgis.Warning)
+
     def finished(self, result):
+        if self.cache is not None:
+            self.cache.close()
+        if result and not self.options.offline:
+            # Calibrates the ETA shown for later exports
+            exportEstimate.record_throughput(self.source_uri, self.pixels_done, self.elapsed)
         self.done.emit(result)
         
+###---------------------Export Queue Classes------------------------------###
+class exportJob:
+    '''An export waiting in or run by the exportQueue. make_task is only
+    called when the job starts, so queued jobs hold no provider clones or
+    cache connections'''
+    def __init__(self, name, make_task):
+        self.name = name
+        self.make_task = make_task
+        self.task = None
+        self.status = 'Queued'# Starting, Running, Cancelling, Done, Failed or Cancelled
+        self.label = ''# last progress text of the task
+        self.percent = 0.0
+        self.failures = 0
+        self.started = None
+        self.ended = None
+
+    def active(self):
+        return self.status in ('Queued', 'Starting', 'Running', 'Cancelling')
+
+    def eta(self):
+        '''Seconds left, from the progress so far. None until it can be told'''
+        if self.status != 'Running' or self.started is None or self.percent <= 0:
+            return None
+        return (time.time()-self.started)*(100-self.percent)/self.percent
+
+    def status_text(self):
+        if self.status == 'Done' and self.failures:
+            return 'Done, {} tiles failed'.format(self.failures)
+        if self.status == 'Running' and self.label:
+            return 'Running {}'.format(self.label)
+        return self.status
+
+
+class exportQueue(QObject):
+    '''Runs exports as QgsTasks in the order they were added, at most
+    max_jobs at once. The tasks share one requestBudget, so the server
+    requests of the jobs running together stay under max_requests and are
+    split fairly between them. changed is emitted whenever the state or
+    progress of a job changes'''
+    changed = pyqtSignal()
+    def __init__(self, max_jobs=2, max_requests=0):
+        QObject.__init__(self)
+        self.jobs = []
+        self.max_jobs = max(1, int(max_jobs))
+        self.budget = requestBudget(max_requests)
+
+    def set_limits(self, max_jobs, max_requests):
+        self.max_jobs = max(1, int(max_jobs))
+        self.budget.set_limit(max_requests)
+        self.start_next()
+
+    def add(self, name, make_task):
+        '''Queue an export. make_task(budget) returns the saveRasters task'''
+        job = exportJob(name, make_task)
+        self.jobs.append(job)
+        self.start_next()
+        self.changed.emit()
+        return job
+
+    def running(self):
+        return [j for j in self.jobs if j.status in ('Starting', 'Running', 'Cancelling')]
+
+    def queued(self):
+        return [j for j in self.jobs if j.status == 'Queued']
+
+    def active(self):
+        return [j for j in self.jobs if j.active()]
+
+    def start_next(self):
+        queued = self.queued()
+        while queued and len(self.running()) < self.max_jobs:
+            job = queued.pop(0)
+            try:
+                job.task = job.make_task(self.budget)
+            except (RuntimeError, OSError, sqlite3.Error) as e:
+                # e.g. a basemap removed from the project while the job was queued
+                QgsMessageLog.logMessage('Could not start export {}: {}'.format(job.name, e), level=Qgis.Warning)
+                job.status = 'Failed'
+                job.ended = time.time()
+                continue
+            job.status = 'Starting'
+            self.connect_job(job)
+            QgsApplication.taskManager().addTask(job.task)
+
+    def connect_job(self, job):
+        job.task.begun.connect(lambda: self.job_begun(job))
+        job.task.progressChanged.connect(lambda p: self.job_progress(job, p))
+        job.task.currentChanged.connect(lambda txt: self.job_label(job, txt))
+        job.task.done.connect(lambda result: self.job_done(job, result))
+
+    def job_begun(self, job):
+        if job.status == 'Starting':
+            job.status = 'Running'
+        job.started = time.time()
+        self.changed.emit()
+
+    def job_progress(self, job, percent):
+        job.percent = percent
+        self.changed.emit()
+
+    def job_label(self, job, txt):
+        job.label = txt
+        self.changed.emit()
+
+    def job_done(self, job, result):
+        job.ended = time.time()
+        job.failures = len(job.task.failures)
+        if job.status == 'Cancelling':
+            job.status = 'Cancelled'
+        elif result:
+            job.status = 'Done'
+            job.percent = 100.0
+            QgsMessageLog.logMessage('Geopackage created successfully: {}'.format(job.name), level=Qgis.Info)
+        else:
+            job.status = 'Failed'
+            QgsMessageLog.logMessage('Export not completed: {}'.format(job.name), level=Qgis.Warning)
+        # the task manager deletes the task once it has finished
+        job.task = None
+        self.start_next()
+        self.changed.emit()
+
+    def cancel(self, job):
+        if job.status == 'Queued':
+            job.status = 'Cancelled'
+            job.ended = time.time()
+        elif job.status in ('Starting', 'Running'):
+            job.status = 'Cancelling'
+            job.task.cancel()
+        self.changed.emit()
+
+    def cancel_all(self):
+        # queued jobs first, so none of them starts in a slot being freed
+        for job in self.queued()+self.running():
+            self.cancel(job)
+
+    def remove(self, job):
+        '''Take a finished job off the list'''
+        if not job.active():
+            self.jobs.remove(job)
+            self.changed.emit()
+
+###---------------------Headless Export-----------------------------------###
+def regular_grid(extent, rows, cols, pixel_sizes, align=None, aoi=None):
+    '''[QgsRectangle, pixel size] cells of a rows x cols grid over extent, in
+    the same order as the dock draws them (rows from the bottom, columns from
+    the left). pixel_sizes is one value for every cell or a list of
+    rows*cols values. align is an optional (span, x0, y0) lattice the cell
+    edges are snapped to, see tileGrid.align. Only the cells intersecting
+    the aoi geometry are returned if one is given'''
+    if isinstance(pixel_sizes, (int, float)):
+        pixel_sizes = [float(pixel_sizes)]*(rows*cols)
+    if len(pixel_sizes) != rows*cols:
+        raise ValueError('Expected 1 or {} pixel sizes, got {}'.format(rows*cols, len(pixel_sizes)))
+    grid = tileGrid(extent, rows, cols, 0.0)
+    grid.px = array('d', pixel_sizes)
+    if align is not None:
+        grid.align(*align)
+    if aoi is not None:
+        grid.clip(aoi)
+    return grid.cells()
+
+
+def export_basemap(source_uri, extent, rows, cols, pixel_sizes, target_crs, output_path,
+                    grid_crs=None, provider='wms', build_overviews=True, options=None,
+                    snap=True, align_edges=False, names=None, aoi=None, mask=False, feedback=None):
+    '''Run an export without the dock widget or a map canvas, e.g. from a
+    script or qgis_process. extent is a QgsRectangle in grid_crs (the source
+    crs if not given), pixel sizes are in source crs units and are snapped to
+    the source's native resolutions unless snap is False. With align_edges
+    the cell edges are moved onto the source's tile matrix (XYZ sources only,
+    grid_crs must be the source crs). source_uri can also be a list of uris, exported over the
+    same grid in one pass into tables prefixed with names (basemap1,
+    basemap2... if not given); the first one is the source the pixel sizes
+    refer to. aoi is an optional geometry in grid_crs: cells that don't
+    intersect it are left out, and with mask the pixels outside its polygons
+    are made transparent. Blocks until the export has finished and returns
+    True on success'''
+    uris = list(source_uri) if isinstance(source_uri, (list, tuple)) else [source_uri]
+    if names is None:
+        names = ['basemap'] if len(uris) == 1 else ['basemap{}'.format(i+1) for i in range(len(uris))]
+    sources = []
+    for uri, name in zip(uris, names):
+        layer = QgsRasterLayer(uri, name, provider)
+        if not layer.isValid():
+            raise ValueError('Could not open basemap source: {}'.format(uri))
+        sources.append(layer)
+    source = sources[0]
+    if grid_crs is None:
+        grid_crs = source.crs()
+    engine = resolutionEngine(source)
+    align = None
+    if align_edges:
+        if grid_crs != source.crs():
+            raise ValueError('Edges can only be aligned to server tiles in the source crs ({})'.format(source.crs().authid()))
+        if not engine.has_matrix_origin():
+            raise ValueError('Edges can only be aligned to the tiles of XYZ sources')
+        sizes = pixel_sizes if isinstance(pixel_sizes, list) else [pixel_sizes]
+        # the coarsest tiles: their edges are also edges of every finer zoom level
+        align = (engine.tile_span(max(sizes)),)+engine.tile_origin()
+    cells = regular_grid(extent, rows, cols, pixel_sizes, align, aoi)
+    if snap:
+        for cell in cells:
+            cell[1] = engine.snap(cell[1])
+    task = saveRasters('Save Raster Tiles to Geopackage', QgsProject.instance(), cells,
+                        sources if len(sources) > 1 else source, output_path, target_crs, build_overviews,
+                        options if options is not None else exportOptions(), grid_crs,
+                        mask=aoi if mask else None)
+    if feedback is not None:
+        task.progressChanged.connect(feedback.setProgress)
+        task.currentChanged.connect(feedback.setProgressText)
+        feedback.canceled.connect(task.cancel)
+    result = task.run()
+    task.finished(result)
+    return result
+
+
+class exportBasemapAlgorithm(QgsProcessingAlgorithm):
+    '''Processing wrapper around export_basemap'''
+    def createInstance(self):
+        return exportBasemapAlgorithm()
+
+    def name(self):
+        return 'exportbasemap'
+
+    def displayName(self):
+        return 'Export basemap to geopackage'
+
+    def shortHelpString(self):
+        return ('Saves a wms/wmts/xyz source to a grid of raster tiles in a geopackage, '
+                'the same as the Basemap2gpkg dock. Several sources, one uri per line, are '
+                'exported over the same grid into tables prefixed basemap1, basemap2 and so on. '
+                'Pixel sizes are in the crs units of the first source, '
+                'either one value for every cell or a comma separated list with one value '
+                'per cell (rows from the bottom, columns from the left).')
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterString('SOURCE', 'Source uri(s), one per line', multiLine=True))
+        self.addParameter(QgsProcessingParameterString('PROVIDER', 'Provider', defaultValue='wms'))
+        self.addParameter(QgsProcessingParameterExtent('EXTENT', 'Grid extent'))
+        self.addParameter(QgsProcessingParameterNumber('ROWS', 'Tile rows', QgsProcessingParameterNumber.Integer, 2, minValue=1))
+        self.addParameter(QgsProcessingParameterNumber('COLS', 'Tile cols', QgsProcessingParameterNumber.Integer, 2, minValue=1))
+        self.addParameter(QgsProcessingParameterString('PIXEL_SIZES', 'Pixel size(s)', defaultValue='5'))
+        self.addParameter(QgsProcessingParameterBoolean('SNAP', 'Snap pixel sizes to server zoom levels', defaultValue=True))
+        self.addParameter(QgsProcessingParameterBoolean('ALIGN', 'Align cell edges to server tiles (XYZ sources only)', defaultValue=False))
+        self.addParameter(QgsProcessingParameterFeatureSource('AOI', 'Only cells over these features',
+                                                            [QgsProcessing.TypeVectorAnyGeometry], optional=True))
+        self.addParameter(QgsProcessingParameterBoolean('MASK', 'Mask pixels outside the AOI polygons', defaultValue=False))
+        self.addParameter(QgsProcessingParameterCrs('TARGET_CRS', 'Target CRS', defaultValue='EPSG:3857'))
+        self.addParameter(QgsProcessingParameterBoolean('OVERVIEWS', 'Build overviews', defaultValue=True))
+        self.addParameter(QgsProcessingParameterBoolean('PYRAMID', 'Write a single tile pyramid table', defaultValue=False))
+        self.addParameter(QgsProcessingParameterEnum('TILE_FORMAT', 'Tile format', tileEncoder.formats,
+                                                    defaultValue=tileEncoder.formats.index('PNG')))
+        self.addParameter(QgsProcessingParameterNumber('QUALITY', 'JPEG/WEBP quality', QgsProcessingParameterNumber.Integer,
+                                                    exportOptions.defaults['tile_quality'], minValue=1, maxValue=100))
+        self.addParameter(QgsProcessingParameterNumber('WORKERS', 'Download threads', QgsProcessingParameterNumber.Integer,
+                                                    exportOptions.defaults['workers'], minValue=1, maxValue=64))
+        self.addParameter(QgsProcessingParameterNumber('RATE_LIMIT', 'Requests per second (0 for no limit)',
+                                                    QgsProcessingParameterNumber.Double, 0.0, minValue=0.0))
+        self.addParameter(QgsProcessingParameterNumber('RETRIES', 'Retries per request', QgsProcessingParameterNumber.Integer,
+                                                    exportOptions.defaults['retries'], minValue=0, maxValue=10))
+        self.addParameter(QgsProcessingParameterNumber('MEMORY_MB', 'Memory budget (MB)', QgsProcessingParameterNumber.Integer,
+                                                    exportOptions.defaults['memory_budget_mb'], minValue=64))
+        self.addParameter(QgsProcessingParameterBoolean('RESUME', 'Resume previous export', defaultValue=False))
+        self.addParameter(QgsProcessingParameterBoolean('REFRESH', 'Refresh tiles that changed on the server', defaultValue=False))
+        self.addParameter(QgsProcessingParameterBoolean('PROBE', 'Store change probes for later refreshes (one extra request per tile)',
+                                                        defaultValue=exportOptions.defaults['probe']))
+        self.addParameter(QgsProcessingParameterFileDestination('OUTPUT', 'Geopackage', 'GeoPackage (*.gpkg)'))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        try:
+            sizes = [float(v) for v in self.parameterAsString(parameters, 'PIXEL_SIZES', context).split(',')]
+        except ValueError:
+            raise QgsProcessingException('Pixel sizes must be numbers separated by commas')
+        rows = self.parameterAsInt(parameters, 'ROWS', context)
+        cols = self.parameterAsInt(parameters, 'COLS', context)
+        output = self.parameterAsFileOutput(parameters, 'OUTPUT', context)
+        grid_crs = self.parameterAsExtentCrs(parameters, 'EXTENT', context)
+        aoi = None
+        aoi_source = self.parameterAsSource(parameters, 'AOI', context)
+        if aoi_source is not None:
+            aoi = QgsGeometry.unaryUnion([f.geometry() for f in aoi_source.getFeatures(QgsFeatureRequest().setNoAttributes())
+                                        if f.hasGeometry()])
+            if aoi.isNull() or aoi.isEmpty():
+                raise QgsProcessingException('The AOI layer has no geometries')
+            if aoi_source.sourceCrs() != grid_crs:
+                aoi.transform(QgsCoordinateTransform(aoi_source.sourceCrs(), grid_crs, context.transformContext()))
+        options = exportOptions(workers=self.parameterAsInt(parameters, 'WORKERS', context),
+                                resume=self.parameterAsBoolean(parameters, 'RESUME', context),
+                                refresh=self.parameterAsBoolean(parameters, 'REFRESH', context),
+                                probe=self.parameterAsBoolean(parameters, 'PROBE', context),
+                                output_mode='pyramid' if self.parameterAsBoolean(parameters, 'PYRAMID', context) else 'tables',
+                                tile_format=tileEncoder.formats[self.parameterAsEnum(parameters, 'TILE_FORMAT', context)],
+                                tile_quality=self.parameterAsInt(parameters, 'QUALITY', context),
+                                rate_limit=self.parameterAsDouble(parameters, 'RATE_LIMIT', context),
+                                retries=self.parameterAsInt(parameters, 'RETRIES', context),
+                                memory_budget_mb=self.parameterAsInt(parameters, 'MEMORY_MB', context))
+        try:
+            uris = [u.strip() for u in self.parameterAsString(parameters, 'SOURCE', context).splitlines() if u.strip()]
+            result = export_basemap(uris if len(uris) > 1 else uris[0],
+                                    self.parameterAsExtent(parameters, 'EXTENT', context),
+                                    rows, cols, sizes[0] if len(sizes) == 1 else sizes,
+                                    self.parameterAsCrs(parameters, 'TARGET_CRS', context),
+                                    output,
+                                    grid_crs=grid_crs,
+                                    provider=self.parameterAsString(parameters, 'PROVIDER', context),
+                                    build_overviews=self.parameterAsBoolean(parameters, 'OVERVIEWS', context),
+                                    options=options,
+                                    snap=self.parameterAsBoolean(parameters, 'SNAP', context),
+                                    align_edges=self.parameterAsBoolean(parameters, 'ALIGN', context),
+                                    aoi=aoi,
+                                    mask=self.parameterAsBoolean(parameters, 'MASK', context),
+                                    feedback=feedback)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        if not result and not feedback.isCanceled():
+            raise QgsProcessingException('Export did not complete, see the log for details')
+        return {'OUTPUT': output}
+
+
+class basemap2GeopackageProvider(QgsProcessingProvider):
+    def loadAlgorithms(self):
+        self.addAlgorithm(exportBasemapAlgorithm())
+
+    def id(self):
+        return 'basemap2gpkg'
+
+    def name(self):
+        return 'Basemap 2 Geopackage'
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icon.png'))
+
 ###------------------------------------------------------------------------###
 
 class mapLayerDialog(QDialog):
@@ -560,17 +3286,40 @@ class mapLayerDialog(QDialog):
         self.lbl = QLabel('Select layer: ', self)
         self.lyr_cb = QgsMapLayerComboBox(self)
         self.lyr_cb.setFilters(QgsMapLayerProxyModel.RasterLayer | QgsMapLayerProxyModel.HasGeometry)
+        self.cb_selected = QCheckBox('Selected features only', self)
+        self.cb_clip = QCheckBox('Only cells over the features', self)
+        self.cb_clip.setToolTip('Leave out the grid cells that do not touch any feature,\n'
+                                'e.g. along a road or pipeline corridor')
+        self.cb_mask = QCheckBox('Mask pixels outside polygons', self)
+        self.cb_mask.setToolTip('Make the pixels outside the polygons transparent. Parts of cells\n'
+                                'entirely outside are not downloaded. Use PNG or AUTO tiles')
+        self.cb_clip.toggled.connect(self.layer_changed)
+        self.lyr_cb.layerChanged.connect(self.layer_changed)
         self.ok_btn = QPushButton('Set Grid Extent', self)
         self.layout = QGridLayout()
         self.layout.addWidget(self.lbl, 0, 0, 1, 1, Qt.AlignCenter)#from row, from column, row span, column span
         self.layout.addWidget(self.lyr_cb, 0, 1, 1, 2)
-        self.layout.addWidget(self.ok_btn, 1, 2, 1, 1)
+        self.layout.addWidget(self.cb_selected, 1, 1, 1, 2)
+        self.layout.addWidget(self.cb_clip, 2, 1, 1, 2)
+        self.layout.addWidget(self.cb_mask, 3, 1, 1, 2)
+        self.layout.addWidget(self.ok_btn, 4, 2, 1, 1)
         self.setLayout(self.layout)
         self.ok_btn.clicked.connect(self.ok)
+        self.layer_changed()
+
+    def layer_changed(self):
+        layer = self.lyr_cb.currentLayer()
+        vector = layer is not None and layer.type() == QgsMapLayer.VectorLayer
+        polygons = vector and layer.geometryType() == QgsWkbTypes.PolygonGeometry
+        self.cb_selected.setEnabled(vector)
+        self.cb_clip.setEnabled(vector)
+        self.cb_mask.setEnabled(polygons and self.cb_clip.isChecked())
         
     def ok(self):
         self.parent.coverage_layer = self.lyr_cb.currentLayer()
-        self.parent.set_grid_to_layer_extent()
+        self.parent.coverage_selected = self.cb_selected.isEnabled() and self.cb_selected.isChecked()
+        self.parent.mask_to_aoi = self.cb_mask.isEnabled() and self.cb_mask.isChecked()
+        self.parent.set_grid_to_layer_extent(self.cb_clip.isEnabled() and self.cb_clip.isChecked())
 #        self.parent.draw_visuals()
         self.hide()
         
@@ -580,12 +3329,30 @@ class resolutionDialog(QDialog):
         QDialog.__init__(self)
         self.setGeometry(750, 300, 325, 150)
         self.setWindowTitle('Set tile download resolution')
-        self.lbl1 = QLabel('Pixel size (meters):', self)
+        self.engine = parent.resolution_engine()
+        name, self.suffix = size_units(self.engine.layer.crs() if self.engine.layer is not None else None)
+        self.lbl1 = QLabel('Pixel size ({}):'.format(name), self)
         self.sb = QDoubleSpinBox(self)
-        self.sb.setRange(0.1, 100.0)
-        self.sb.setSingleStep(0.5)
+        # enough decimals for three significant figures of the finest size
+        # likely to be used, e.g. 0.00001 degrees
+        finest = min(self.engine.resolutions+[parent.default_pixel_size])
+        decimals = max(3, 3-int(math.floor(math.log10(finest)))) if finest > 0 else 3
+        self.sb.setDecimals(decimals)
+        self.sb.setRange(10**-decimals, 100000.0)
+        self.sb.setSingleStep(10**math.floor(math.log10(finest)) if finest > 0 else 0.5)
         self.sb.setStepType(QAbstractSpinBox.DefaultStepType)
         self.sb.selectAll()
+        self.lbl_zoom = QLabel('Zoom level:', self)
+        self.cmb_zoom = QComboBox(self)
+        self.cmb_zoom.addItem('Custom', None)
+        for level, res in self.engine.zoom_levels():
+            self.cmb_zoom.addItem('Level {} ({})'.format(level, format_pixel_size(res, self.suffix)), res)
+        self.cmb_zoom.setEnabled(bool(self.engine.resolutions))
+        self.cmb_zoom.activated.connect(self.zoom_selected)
+        self.lbl_snap = QLabel('Snap to server tiles: ', self)
+        self.cb_snap = QCheckBox(self)
+        self.cb_snap.setCheckState(Qt.Checked if self.engine.resolutions else Qt.Unchecked)
+        self.cb_snap.setEnabled(bool(self.engine.resolutions))
         self.lbl2 = QLabel('Apply to all: ', self)
         self.cb = QCheckBox(self)
         self.btn_ok = QPushButton('OK', self)
@@ -594,11 +3361,34 @@ class resolutionDialog(QDialog):
         #QWidget *widget, int fromRow, int fromColumn, int rowSpan, int columnSpan, Qt::Alignment alignment
         self.layout.addWidget(self.lbl1, 0, 0, 1, 1)
         self.layout.addWidget(self.sb, 0, 1, 1, 1)
-        self.layout.addWidget(self.lbl2, 1, 0, 1, 1)
-        self.layout.addWidget(self.cb, 1, 1, 1, 1)
-        self.layout.addWidget(self.btn_ok, 2, 1, 1, 1)
+        self.layout.addWidget(self.lbl_zoom, 1, 0, 1, 1)
+        self.layout.addWidget(self.cmb_zoom, 1, 1, 1, 1)
+        self.layout.addWidget(self.lbl_snap, 2, 0, 1, 1)
+        self.layout.addWidget(self.cb_snap, 2, 1, 1, 1)
+        self.layout.addWidget(self.lbl2, 3, 0, 1, 1)
+        self.layout.addWidget(self.cb, 3, 1, 1, 1)
+        self.layout.addWidget(self.btn_ok, 4, 1, 1, 1)
         self.setLayout(self.layout)
-        
+
+    def set_pixel_size(self, pixel_size):
+        self.sb.setValue(pixel_size)
+        level = self.engine.zoom_for(pixel_size) if self.engine.snap(pixel_size) == pixel_size else None
+        self.cmb_zoom.setCurrentIndex(0 if level is None else level+1)
+
+    def zoom_selected(self, index):
+        res = self.cmb_zoom.itemData(index)
+        if res is not None:
+            self.sb.setValue(res)
+
+    def pixel_size(self):
+        '''The chosen pixel size, snapped to the server's zoom levels if requested'''
+        if (self.cmb_zoom.currentData() is not None and
+                round(self.cmb_zoom.currentData(), self.sb.decimals()) == round(self.sb.value(), self.sb.decimals())):
+            return self.cmb_zoom.currentData()
+        if self.cb_snap.checkState() == 2:
+            return self.engine.snap(self.sb.value())
+        return self.sb.value()
+
     def ok_clicked(self):
         self.accept()
 
@@ -607,7 +3397,7 @@ class SaveDialog(QDialog):
     def __init__(self, parent):
         QDialog.__init__(self)
         self.parent = parent
-        self.setGeometry(500, 250, 650, 350)
+        self.setGeometry(500, 250, 650, 650)
         self.lbl_save_path = QLabel('File Path:', self)
         self.le_save_path = QLineEdit(self)
         self.btn_save_path = QPushButton('...', self)
@@ -617,9 +3407,122 @@ class SaveDialog(QDialog):
         self.sel_prj.setCrs(QgsProject.instance().crs())
         self.sel_prj.setOptionVisible(QgsProjectionSelectionWidget.RecentCrs, True)
         self.sel_prj.setMaximumHeight(self.btn_save_path.height())
+        self.lbl_sources = QLabel('Basemaps:', self)
+        self.lst_sources = QListWidget(self)
+        self.lst_sources.setMaximumHeight(80)
+        self.lst_sources.setToolTip('Every checked basemap is exported over the same grid in one pass,\n'
+                                    'each into its own tables named after the layer')
+        active = self.parent.iface.activeLayer()
+        for layer in QgsProject.instance().mapLayers().values():
+            if layer.providerType() != 'wms':
+                continue
+            item = QListWidgetItem(layer.name(), self.lst_sources)
+            item.setData(Qt.UserRole, layer.id())
+            item.setCheckState(Qt.Checked if layer == active else Qt.Unchecked)
+        self.lbl_resume = QLabel('Resume previous export', self)
+        self.cb_resume = QCheckBox(self)
+        self.cb_resume.setToolTip('Only download tiles that are missing or incomplete in an existing geopackage')
         self.lbl_overviews = QLabel('Build Overviews ', self)
         self.cb_overviews = QCheckBox(self)
         self.cb_overviews.setCheckState(Qt.Checked)
+        self.le_levels = QLineEdit(self)
+        self.le_levels.setToolTip('Overview levels, e.g. 2 4 8 16 (powers of two)')
+        self.cmb_resampling = QComboBox(self)
+        self.cmb_resampling.addItems(['average', 'nearest'])
+        self.cmb_resampling.setToolTip('Overview resampling method')
+        self.options = exportOptions.from_settings()
+        self.lbl_workers = QLabel('Download threads:', self)
+        self.sb_workers = QSpinBox(self)
+        self.sb_workers.setRange(1, 16)
+        self.sb_workers.setValue(self.options.workers)
+        self.sb_workers.setToolTip('Number of grid cells fetched from the server at the same time')
+        self.lbl_batch = QLabel('Tables per commit:', self)
+        self.sb_batch = QSpinBox(self)
+        self.sb_batch.setRange(1, 1000)
+        self.sb_batch.setValue(self.options.batch_size)
+        self.sb_batch.setToolTip('Number of tile tables written to the geopackage in one transaction')
+        self.cb_resume.setCheckState(Qt.Checked if self.options.resume else Qt.Unchecked)
+        self.lbl_refresh = QLabel('Refresh changed tiles', self)
+        self.cb_refresh = QCheckBox(self)
+        self.cb_refresh.setCheckState(Qt.Checked if self.options.refresh else Qt.Unchecked)
+        self.cb_refresh.setToolTip('Update an existing geopackage exported with the same grid: each tile is\n'
+                                'checked against the server and only the ones that changed are downloaded')
+        self.lbl_probe = QLabel('Store change probes', self)
+        self.cb_probe = QCheckBox(self)
+        self.cb_probe.setCheckState(Qt.Checked if self.options.probe else Qt.Unchecked)
+        self.cb_probe.setToolTip('Fetch a small extra rendering of each tile so a later refresh can tell\n'
+                                'whether it changed. Tiles saved without one are always downloaded again')
+        self.lbl_cache = QLabel('Use local cache', self)
+        self.cb_cache = QCheckBox(self)
+        self.cb_cache.setCheckState(Qt.Checked if self.options.cache else Qt.Unchecked)
+        self.cb_cache.setToolTip('Keep downloaded data on disk and reuse it for later exports of the same area')
+        self.lbl_cache_size = QLabel('Cache size (MB):', self)
+        self.sb_cache_size = QSpinBox(self)
+        self.sb_cache_size.setRange(64, 1024*1024)
+        self.sb_cache_size.setValue(self.options.cache_size_mb)
+        self.lbl_cache_ttl = QLabel('Expire after (days):', self)
+        self.sb_cache_ttl = QSpinBox(self)
+        self.sb_cache_ttl.setRange(1, 3650)
+        self.sb_cache_ttl.setValue(self.options.cache_ttl_days)
+        self.lbl_format = QLabel('Tile format:', self)
+        self.cmb_format = QComboBox(self)
+        self.cmb_format.addItems(tileEncoder.formats)
+        self.cmb_format.setCurrentText(self.options.tile_format.upper())
+        self.cmb_format.setToolTip('AUTO writes JPEG for opaque tiles and PNG where there is transparency')
+        self.sb_quality = QSpinBox(self)
+        self.sb_quality.setRange(1, 100)
+        self.sb_quality.setValue(self.options.tile_quality)
+        self.sb_quality.setToolTip('JPEG/WEBP quality')
+        self.lbl_drop_empty = QLabel('Skip empty tiles', self)
+        self.cb_drop_empty = QCheckBox(self)
+        self.cb_drop_empty.setCheckState(Qt.Checked if self.options.drop_empty else Qt.Unchecked)
+        self.cb_drop_empty.setToolTip('Leave fully transparent tiles out of the geopackage')
+        self.lbl_memory = QLabel('Memory budget (MB):', self)
+        self.sb_memory = QSpinBox(self)
+        self.sb_memory.setRange(64, 65536)
+        self.sb_memory.setValue(self.options.memory_budget_mb)
+        self.sb_memory.setToolTip('Large cells are downloaded in parts so the export stays within this much memory')
+        self.lbl_rate = QLabel('Requests/s:', self)
+        self.sb_rate = QDoubleSpinBox(self)
+        self.sb_rate.setRange(0.0, 1000.0)
+        self.sb_rate.setValue(self.options.rate_limit)
+        self.sb_rate.setSpecialValueText('No limit')
+        self.sb_rate.setToolTip('Maximum number of requests sent to the server per second')
+        self.lbl_max_requests = QLabel('Concurrent requests:', self)
+        self.sb_max_requests = QSpinBox(self)
+        self.sb_max_requests.setRange(0, 64)
+        self.sb_max_requests.setValue(self.options.max_requests)
+        self.sb_max_requests.setSpecialValueText('No limit')
+        self.lbl_max_jobs = QLabel('Exports at once:', self)
+        self.sb_max_jobs = QSpinBox(self)
+        self.sb_max_jobs.setRange(1, 16)
+        self.sb_max_jobs.setValue(self.options.max_jobs)
+        self.sb_max_jobs.setToolTip('Exports run at the same time, later ones wait in the queue')
+        self.lbl_total_requests = QLabel('Requests, all exports:', self)
+        self.sb_total_requests = QSpinBox(self)
+        self.sb_total_requests.setRange(0, 256)
+        self.sb_total_requests.setValue(self.options.max_total_requests)
+        self.sb_total_requests.setSpecialValueText('No limit')
+        self.sb_total_requests.setToolTip('Server requests in flight over all running exports,\n'
+                                        'shared evenly between them')
+        self.lbl_retries = QLabel('Retries:', self)
+        self.sb_retries = QSpinBox(self)
+        self.sb_retries.setRange(0, 10)
+        self.sb_retries.setValue(self.options.retries)
+        self.sb_retries.setToolTip('Attempts after a failed request, waiting longer each time')
+        self.lbl_output = QLabel('Output:', self)
+        self.cmb_output = QComboBox(self)
+        self.cmb_output.addItem('Table per tile', 'tables')
+        self.cmb_output.addItem('Single tile pyramid', 'pyramid')
+        self.cmb_output.setCurrentIndex(max(0, self.cmb_output.findData(self.options.output_mode)))
+        self.cmb_output.setToolTip('Write every grid cell to its own raster table, or all of them into one '
+                                'tiles table with a zoom level per resolution')
+        self.lbl_offline = QLabel('Offline (cache only)', self)
+        self.cb_offline = QCheckBox(self)
+        self.cb_offline.setCheckState(Qt.Checked if self.options.offline else Qt.Unchecked)
+        self.cb_offline.setToolTip('Export only what is already in the cache without contacting the server')
+        self.le_levels.setText(self.options.overview_levels)
+        self.cmb_resampling.setCurrentText(self.options.overview_resampling)
         self.btn_accept = QPushButton('Save', self)
         self.btn_accept.clicked.connect(lambda: self.accept())
         self.btn_reject = QPushButton('Cancel', self)
@@ -631,13 +3534,96 @@ class SaveDialog(QDialog):
         self.layout.addWidget(self.btn_save_path, 0, 5, 1, 1)
         self.layout.addWidget(self.lbl_prj, 1, 0, 1, 1, Qt.AlignCenter)
         self.layout.addWidget(self.sel_prj, 1, 1, 1, 5)
-        self.layout.addWidget(self.lbl_overviews, 2, 1, 1, 1)
-        self.layout.addWidget(self.cb_overviews,2, 2, 1, 4)
-        self.layout.addWidget(self.btn_accept, 2, 4, 1, 1)
-        self.layout.addWidget(self.btn_reject, 2, 5, 1, 1)
-        self.layout.setVerticalSpacing(65)
+        self.layout.addWidget(self.lbl_sources, 2, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.lst_sources, 2, 1, 1, 5)
+        self.layout.addWidget(self.lbl_workers, 3, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.sb_workers, 3, 1, 1, 1)
+        self.layout.addWidget(self.lbl_batch, 3, 2, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.sb_batch, 3, 3, 1, 1)
+        self.layout.addWidget(self.lbl_resume, 3, 4, 1, 1)
+        self.layout.addWidget(self.cb_resume, 3, 5, 1, 1)
+        self.layout.addWidget(self.lbl_cache, 4, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.cb_cache, 4, 1, 1, 1)
+        self.layout.addWidget(self.lbl_cache_size, 4, 2, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.sb_cache_size, 4, 3, 1, 1)
+        self.layout.addWidget(self.lbl_cache_ttl, 5, 2, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.sb_cache_ttl, 5, 3, 1, 1)
+        self.layout.addWidget(self.lbl_output, 5, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.cmb_output, 5, 1, 1, 1)
+        self.layout.addWidget(self.lbl_drop_empty, 5, 4, 1, 1)
+        self.layout.addWidget(self.cb_drop_empty, 5, 5, 1, 1)
+        self.layout.addWidget(self.lbl_format, 6, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.cmb_format, 6, 1, 1, 1)
+        self.layout.addWidget(self.sb_quality, 6, 2, 1, 1)
+        self.layout.addWidget(self.lbl_memory, 6, 3, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.sb_memory, 6, 4, 1, 1)
+        self.layout.addWidget(self.lbl_rate, 7, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.sb_rate, 7, 1, 1, 1)
+        self.layout.addWidget(self.lbl_max_requests, 7, 2, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.sb_max_requests, 7, 3, 1, 1)
+        self.layout.addWidget(self.lbl_retries, 7, 4, 1, 1)
+        self.layout.addWidget(self.sb_retries, 7, 5, 1, 1)
+        self.layout.addWidget(self.lbl_offline, 4, 4, 1, 1)
+        self.layout.addWidget(self.cb_offline, 4, 5, 1, 1)
+        self.layout.addWidget(self.lbl_overviews, 8, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.cb_overviews, 8, 1, 1, 1)
+        self.layout.addWidget(self.le_levels, 8, 2, 1, 1)
+        self.layout.addWidget(self.cmb_resampling, 8, 3, 1, 1)
+        self.layout.addWidget(self.lbl_max_jobs, 8, 4, 1, 1)
+        self.layout.addWidget(self.sb_max_jobs, 8, 5, 1, 1)
+        self.layout.addWidget(self.lbl_refresh, 9, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.cb_refresh, 9, 1, 1, 1)
+        self.layout.addWidget(self.lbl_total_requests, 9, 2, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.sb_total_requests, 9, 3, 1, 1)
+        self.layout.addWidget(self.lbl_probe, 10, 0, 1, 1, Qt.AlignCenter)
+        self.layout.addWidget(self.cb_probe, 10, 1, 1, 1)
+        self.layout.addWidget(self.btn_accept, 10, 4, 1, 1)
+        self.layout.addWidget(self.btn_reject, 10, 5, 1, 1)
+        self.layout.setVerticalSpacing(30)
         self.setLayout(self.layout)
         
+    def selected_sources(self):
+        '''The checked basemap layers, the active layer (the one the grid was
+        built for) first if it is checked. The export is planned in the first
+        one, run_save_task converts the pixel sizes if it is another layer'''
+        layers = []
+        for i in range(self.lst_sources.count()):
+            item = self.lst_sources.item(i)
+            layer = QgsProject.instance().mapLayer(item.data(Qt.UserRole))
+            if item.checkState() == Qt.Checked and layer is not None:
+                layers.append(layer)
+        active = self.parent.iface.activeLayer()
+        if active in layers:
+            layers.remove(active)
+            layers.insert(0, active)
+        return layers
+
+    def get_options(self):
+        '''Read the export options from the dialog and remember them for next time'''
+        self.options.workers = self.sb_workers.value()
+        self.options.batch_size = self.sb_batch.value()
+        self.options.resume = self.cb_resume.checkState() == 2
+        self.options.refresh = self.cb_refresh.checkState() == 2
+        self.options.probe = self.cb_probe.checkState() == 2
+        self.options.cache = self.cb_cache.checkState() == 2
+        self.options.cache_size_mb = self.sb_cache_size.value()
+        self.options.cache_ttl_days = self.sb_cache_ttl.value()
+        self.options.offline = self.cb_offline.checkState() == 2
+        self.options.overview_levels = self.le_levels.text()
+        self.options.overview_resampling = self.cmb_resampling.currentText()
+        self.options.output_mode = self.cmb_output.currentData()
+        self.options.tile_format = self.cmb_format.currentText()
+        self.options.rate_limit = self.sb_rate.value()
+        self.options.max_requests = self.sb_max_requests.value()
+        self.options.max_jobs = self.sb_max_jobs.value()
+        self.options.max_total_requests = self.sb_total_requests.value()
+        self.options.retries = self.sb_retries.value()
+        self.options.memory_budget_mb = self.sb_memory.value()
+        self.options.tile_quality = self.sb_quality.value()
+        self.options.drop_empty = self.cb_drop_empty.checkState() == 2
+        self.options.save()
+        return self.options
+        
     def get_save_path(self):
         file_name = QFileDialog().getSaveFileName(self.parent.iface.mainWindow(), 'Save Tiles to Geopackage', '', filter='*.gpkg')
         if file_name:
@@ -652,6 +3638,12 @@ class SaveDialog(QDialog):
 ############################################################################
 
 class mapToolCustomise(QgsMapToolEmitPoint):
+    '''Click a cell to set its pixel size, right click to remove it.
+    Drag a box or ctrl+click to select several cells, then click or right
+    click inside the selection to change or remove all of them at once.
+    Esc clears the selection and Delete removes it'''
+    drag_tolerance = 4# pixels the mouse can move before a click becomes a drag
+
     def __init__(self, canvas, parent):
         self.canvas = canvas
         self.parent = parent
@@ -660,44 +3652,99 @@ class mapToolCustomise(QgsMapToolEmitPoint):
         self.cursor.setShape(Qt.ArrowCursor)
         self.setCursor(self.cursor)
         self.point = None
+        self.press_pos = None
+        self.indices = []
+        self.selected = set()
+        self.box = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
+        self.box.setStrokeColor(QColor('Red'))
+        self.box.setFillColor(QColor(255, 0, 0, 20))
         
     def canvasPressEvent(self, e):
         self.point = e.mapPoint()
-        if QgsGeometry().fromRect(self.parent.rect).contains(e.mapPoint()):
-            if e.button() == Qt.LeftButton:
-                current_resolution = [rb[1] for rb in self.parent.grid_rubber_bands if rb[0].asGeometry().contains(e.mapPoint())][0]
-                self.dlg = resolutionDialog(self.parent)
-                self.dlg.sb.setValue(current_resolution)
-                self.dlg.show()
-                self.dlg.accepted.connect(self.set_resolution)
-            elif e.button() == Qt.RightButton:
-                for rb in self.parent.grid_rubber_bands:
-                        if rb[0].asGeometry().contains(e.mapPoint()):
-                            rb[0].setStrokeColor(QColor('Red'))
-                            m = QMessageBox()
-                            m.addButton(QPushButton('Cancel'), QMessageBox.RejectRole)
-                            m.addButton(QPushButton('OK'), QMessageBox.AcceptRole)
-                            m.setText('Remove grid tile?')
-                            result = m.exec_()
-                            if result == 1:#Removes grid cell even if 'X' button clicked!!
-                                rb[0].reset()
-                                self.parent.grid_rubber_bands.remove(rb)
-                                self.parent.draw_from_stored_lists()
-                            elif result == 0:
-                                rb[0].setStrokeColor(QColor('Black'))
-            
+        self.press_pos = e.pos()
+
+    def canvasMoveEvent(self, e):
+        if self.press_pos is None or not e.buttons() & Qt.LeftButton:
+            return
+        if (e.pos()-self.press_pos).manhattanLength() > self.drag_tolerance:
+            self.box.setToGeometry(QgsGeometry.fromRect(QgsRectangle(self.point, e.mapPoint())), None)
+
+    def canvasReleaseEvent(self, e):
+        grid = self.parent.grid
+        dragged = self.press_pos is not None and (e.pos()-self.press_pos).manhattanLength() > self.drag_tolerance
+        self.press_pos = None
+        self.box.reset(QgsWkbTypes.PolygonGeometry)
+        if grid is None:
+            return
+        ctrl = e.modifiers() & Qt.ControlModifier
+        if dragged and e.button() == Qt.LeftButton:
+            hits = grid.indices_in(QgsRectangle(self.point, e.mapPoint()))
+            self.selected = self.selected | set(hits) if ctrl else set(hits)
+            self.show_selection()
+            return
+        i = grid.index_at(self.point)
+        if i is None:
+            return
+        if ctrl:
+            self.selected ^= {i}
+            self.show_selection()
+            return
+        if i in self.selected:
+            self.indices = sorted(self.selected)
+        else:
+            self.selected = set()
+            self.show_selection()
+            self.indices = [i]
+        if e.button() == Qt.LeftButton:
+            self.dlg = resolutionDialog(self.parent)
+            self.dlg.set_pixel_size(grid.px[i])
+            self.dlg.show()
+            self.dlg.accepted.connect(self.set_resolution)
+        elif e.button() == Qt.RightButton:
+            self.remove_cells(self.indices)
+
+    def keyPressEvent(self, e):
+        if e.key() == Qt.Key_Escape:
+            self.selected = set()
+            self.show_selection()
+        elif e.key() in (Qt.Key_Delete, Qt.Key_Backspace) and self.selected:
+            self.remove_cells(sorted(self.selected))
+
+    def show_selection(self):
+        self.parent.grid_view.highlight_cells(self.parent.grid, sorted(self.selected))
+
+    def remove_cells(self, indices):
+        grid = self.parent.grid
+        self.parent.grid_view.highlight_cells(grid, indices)
+        m = QMessageBox()
+        m.addButton(QPushButton('Cancel'), QMessageBox.RejectRole)
+        m.addButton(QPushButton('OK'), QMessageBox.AcceptRole)
+        m.setText('Remove grid tile?' if len(indices) == 1 else 'Remove {} grid tiles?'.format(len(indices)))
+        result = m.exec_()
+        if result == 1:#Removes grid cell even if 'X' button clicked!!
+            grid.remove_many(indices)
+            self.selected -= set(indices)
+            self.parent.draw_from_stored_lists()
+        self.show_selection()
             
     def set_resolution(self):
 #        print(self.point)
-        res = self.dlg.sb.value()
+        res = self.dlg.pixel_size()
         if self.dlg.cb.checkState() == 0:
-            for rb in self.parent.grid_rubber_bands:
-                if rb[0].asGeometry().contains(self.point):
-                    rb[1] = res
+            self.parent.grid.set_pixel_sizes(self.indices, res)
         elif self.dlg.cb.checkState() == 2:
-            for rb in self.parent.grid_rubber_bands:
-                rb[1] = res
+            self.parent.grid.set_all(res)
+        if self.parent.dlg.cb_align.isChecked():
+            # a coarser pixel size needs the edges on its own, larger tiles
+            self.parent.align_grid()
         self.parent.draw_from_stored_lists()
+
+    def deactivate(self):
+        self.box.reset(QgsWkbTypes.PolygonGeometry)
+        self.selected = set()
+        if self.parent.grid is not None:
+            self.show_selection()
+        QgsMapToolEmitPoint.deactivate(self)
     
 
 
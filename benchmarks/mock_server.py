@@ -0,0 +1,228 @@
+'''
+Local stand-in for a basemap server, used by run_benchmarks.py.
+
+Serves synthetic imagery as XYZ tiles (a tiled source with native zoom
+levels, like a WMTS) and as a plain WMS 1.3.0 GetMap endpoint, with
+configurable latency, bandwidth and error rate. Images are generated in
+pure Python from the requested map coordinates, so neighbouring requests
+line up and the same request always returns the same bytes.
+
+Run on its own to point QGIS at it by hand:
+
+    python mock_server.py --port 8000 --latency 0.05 --bandwidth 4 --error-rate 0.01
+
+XYZ source:  type=xyz&url=http://127.0.0.1:8000/xyz/{z}/{x}/{y}.png&zmin=0&zmax=19
+WMS source:  crs=EPSG:3857&format=image/png&layers=synthetic&styles=&url=http://127.0.0.1:8000/wms
+'''
+import argparse
+import math
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+WEB_MERCATOR_MAX = 20037508.342789244
+TILE_SIZE = 256
+
+CAPABILITIES = '''<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms" xmlns:xlink="http://www.w3.org/1999/xlink">
+<Service><Name>WMS</Name><Title>Benchmark mock server</Title></Service>
+<Capability>
+<Request>
+<GetCapabilities><Format>text/xml</Format><DCPType><HTTP><Get><OnlineResource xlink:href="{url}?"/></Get></HTTP></DCPType></GetCapabilities>
+<GetMap><Format>image/png</Format><DCPType><HTTP><Get><OnlineResource xlink:href="{url}?"/></Get></HTTP></DCPType></GetMap>
+</Request>
+<Exception><Format>XML</Format></Exception>
+<Layer>
+<Title>Benchmark mock server</Title>
+<CRS>EPSG:3857</CRS>
+<EX_GeographicBoundingBox><westBoundLongitude>-180</westBoundLongitude><eastBoundLongitude>180</eastBoundLongitude>
+<southBoundLatitude>-85</southBoundLatitude><northBoundLatitude>85</northBoundLatitude></EX_GeographicBoundingBox>
+<BoundingBox CRS="EPSG:3857" minx="{m:.6f}" miny="{m:.6f}" maxx="{p:.6f}" maxy="{p:.6f}"/>
+<Layer queryable="0"><Name>synthetic</Name><Title>Synthetic imagery</Title>
+<CRS>EPSG:3857</CRS>
+<BoundingBox CRS="EPSG:3857" minx="{m:.6f}" miny="{m:.6f}" maxx="{p:.6f}" maxy="{p:.6f}"/>
+</Layer>
+</Layer>
+</Capability>
+</WMS_Capabilities>
+'''
+
+
+def png_bytes(width, height, rows):
+    '''Encode an RGB image given as a list of height row byte strings'''
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data))+kind+data+
+                struct.pack('>I', zlib.crc32(kind+data) & 0xffffffff))
+    raw = b''.join(b'\x00'+row for row in rows)
+    return (b'\x89PNG\r\n\x1a\n'+
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))+
+            chunk(b'IDAT', zlib.compress(raw, 6))+
+            chunk(b'IEND', b''))
+
+
+def synthetic_image(xmin, ymin, xmax, ymax, width, height):
+    '''PNG of a checkerboard of coloured squares on a lattice anchored at
+    the crs origin, about 32 pixels across at the requested resolution.
+    Rows and runs of equal colour are built once and repeated, which keeps
+    large GetMap requests cheap without numpy'''
+    res_x = (xmax-xmin)/width
+    res_y = (ymax-ymin)/height
+    # a power of two so the pattern only changes between zoom levels
+    cell = 2.0**math.ceil(math.log2(32*res_x))
+    # column runs: (cell index, run length)
+    runs = []
+    for c in range(width):
+        i = int((xmin+(c+0.5)*res_x)//cell)
+        if runs and runs[-1][0] == i:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    cache = {}
+    rows = []
+    for r in range(height):
+        j = int((ymax-(r+0.5)*res_y)//cell)
+        if j not in cache:
+            cache[j] = b''.join(bytes(((i*37+j*91) % 200+30, (i*17) % 200+30, (j*23) % 200+30))*n
+                                for i, n in runs)
+        rows.append(cache[j])
+    return png_bytes(width, height, rows)
+
+
+def tile_bounds(z, x, y):
+    size = 2*WEB_MERCATOR_MAX/2**z
+    xmin = -WEB_MERCATOR_MAX+x*size
+    ymax = WEB_MERCATOR_MAX-y*size
+    return xmin, ymax-size, xmin+size, ymax
+
+
+class mockServer:
+    '''Threaded HTTP server answering XYZ tile and WMS requests. latency is
+    seconds added to every response, bandwidth the MB/s each response is
+    sent at (0 for no limit) and error_rate the share of image requests
+    answered with HTTP 503. The error pattern is seeded so runs repeat.
+    Counters are kept for the benchmark report'''
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, bandwidth=0.0, error_rate=0.0, seed=1):
+        self.latency = latency
+        self.bandwidth = bandwidth*1024*1024
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def xyz_uri(self, zmax=19):
+        return 'type=xyz&url={}/xyz/{{z}}/{{x}}/{{y}}.png&zmin=0&zmax={}'.format(self.url, zmax)
+
+    def wms_uri(self):
+        return 'crs=EPSG:3857&format=image/png&layers=synthetic&styles=&url={}/wms'.format(self.url)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def counters(self):
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'bytes_sent': self.bytes_sent}
+
+    def fail_next(self):
+        with self.lock:
+            self.requests += 1
+            fail = self.error_rate > 0 and self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return fail
+
+    def handler_class(self):
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            def log_message(self, fmt, *args):
+                pass
+
+            def send(self, status, content_type, body):
+                if server.latency:
+                    time.sleep(server.latency)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                # keep QGIS's network cache out of the measurements
+                self.send_header('Cache-Control', 'no-store')
+                if status == 503:
+                    self.send_header('Retry-After', '1')
+                self.end_headers()
+                step = 16384
+                for i in range(0, len(body), step):
+                    part = body[i:i+step]
+                    self.wfile.write(part)
+                    if server.bandwidth:
+                        time.sleep(len(part)/server.bandwidth)
+                with server.lock:
+                    server.bytes_sent += len(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    if url.path.startswith('/xyz/'):
+                        z, x, y = url.path[5:].rsplit('.', 1)[0].split('/')
+                        self.image(tile_bounds(int(z), int(x), int(y)), TILE_SIZE, TILE_SIZE)
+                    elif url.path.rstrip('/') == '/wms':
+                        self.wms({k.upper(): v[0] for k, v in parse_qs(url.query).items()})
+                    else:
+                        self.send(404, 'text/plain', b'Not found')
+                except (ValueError, KeyError) as e:
+                    self.send(400, 'text/plain', 'Bad request: {}'.format(e).encode('utf-8'))
+
+            def wms(self, params):
+                request = params.get('REQUEST', '').lower()
+                if request == 'getcapabilities':
+                    xml = CAPABILITIES.format(url=server.url+'/wms', m=-WEB_MERCATOR_MAX, p=WEB_MERCATOR_MAX)
+                    self.send(200, 'text/xml', xml.encode('utf-8'))
+                elif request == 'getmap':
+                    bbox = [float(v) for v in params['BBOX'].split(',')]
+                    self.image(bbox, int(params['WIDTH']), int(params['HEIGHT']))
+                else:
+                    self.send(400, 'text/plain', b'Unsupported request')
+
+            def image(self, bbox, width, height):
+                if server.fail_next():
+                    self.send(503, 'text/plain', b'Service temporarily unavailable')
+                    return
+                self.send(200, 'image/png', synthetic_image(bbox[0], bbox[1], bbox[2], bbox[3], width, height))
+
+        return handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic basemap imagery for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each response')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='MB/s per response, 0 for no limit')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of image requests failing with 503')
+    args = parser.parse_args()
+    server = mockServer(args.host, args.port, args.latency, args.bandwidth, args.error_rate)
+    print('Serving on {}'.format(server.url))
+    print('XYZ: {}'.format(server.xyz_uri()))
+    print('WMS: {}'.format(server.wms_uri()))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
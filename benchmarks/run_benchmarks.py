@@ -0,0 +1,241 @@
+'''
+Export throughput benchmarks against the local mock server.
+
+Needs a Python with the QGIS bindings (the OSGeo4W shell, or python3 with
+PYTHONPATH pointing at the QGIS python folder). The mock server runs in this
+process and each scenario is exported in a child process, so peak memory is
+measured per scenario:
+
+    python run_benchmarks.py                        # every scenario
+    python run_benchmarks.py --quick grid_10x10     # smaller extents, one scenario
+    python run_benchmarks.py --latency 0.05 --bandwidth 8 --error-rate 0.01
+    python run_benchmarks.py --baseline results/20261018-101500.json --max-regression 10
+
+Each run is saved to results/<timestamp>.json. With --baseline the run is
+compared scenario by scenario, and the exit status is 1 if the tiles/s of
+any scenario dropped by more than --max-regression percent.
+'''
+import argparse
+import collections
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_server import mockServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(HERE)
+MB = 1024*1024
+# south-west corner of the grids, in EPSG:3857 metres
+ORIGIN = (1000000.0, 6000000.0)
+
+# size is the side of the grid extent in metres, pixel sizes are snapped to
+# the zoom levels of the xyz source
+SCENARIOS = collections.OrderedDict([
+    ('huge_1x1', {'source': 'xyz', 'size': 20480, 'rows': 1, 'cols': 1, 'pixel_sizes': 2.0, 'target': 'EPSG:3857'}),
+    ('grid_10x10', {'source': 'xyz', 'size': 20480, 'rows': 10, 'cols': 10, 'pixel_sizes': 2.0, 'target': 'EPSG:3857'}),
+    ('grid_50x50', {'source': 'xyz', 'size': 51200, 'rows': 50, 'cols': 50, 'pixel_sizes': 2.0, 'target': 'EPSG:3857'}),
+    ('mixed_sizes', {'source': 'xyz', 'size': 20480, 'rows': 8, 'cols': 8, 'pixel_sizes': [1.0, 2.0, 4.0, 8.0]*16,
+                    'target': 'EPSG:3857'}),
+    ('reprojected', {'source': 'xyz', 'size': 20480, 'rows': 10, 'cols': 10, 'pixel_sizes': 2.0, 'target': 'EPSG:4326'}),
+    ('wms_10x10', {'source': 'wms', 'size': 20480, 'rows': 10, 'cols': 10, 'pixel_sizes': 2.0, 'target': 'EPSG:3857'}),
+])
+
+
+def peak_rss_mb():
+    '''Peak resident memory of this process, None where it can't be read'''
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return round(peak/(MB if sys.platform == 'darwin' else 1024), 1)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return round(getattr(info, 'peak_wset', info.rss)/MB, 1)
+
+
+def count_tiles(path):
+    '''Tiles and bytes stored at the base (finest) zoom level of every tiles
+    table, and the number of overview tiles above it. The exports run here
+    write a table per cell, so the finest level holds the downloaded tiles'''
+    conn = sqlite3.connect(path)
+    tiles = nbytes = overviews = 0
+    try:
+        tables = [r[0] for r in conn.execute("SELECT table_name FROM gpkg_contents WHERE data_type='tiles'")]
+        for t in tables:
+            base = conn.execute('SELECT MAX(zoom_level) FROM "{}"'.format(t)).fetchone()[0]
+            if base is None:
+                continue
+            n, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(tile_data)), 0) FROM "{}" WHERE zoom_level=?'.format(t),
+                                    (base,)).fetchone()
+            tiles += n
+            nbytes += size
+            overviews += conn.execute('SELECT COUNT(*) FROM "{}" WHERE zoom_level<?'.format(t), (base,)).fetchone()[0]
+        return tiles, nbytes, overviews
+    finally:
+        conn.close()
+
+
+def plugin_version():
+    with open(os.path.join(PLUGIN_DIR, 'metadata.txt')) as f:
+        for line in f:
+            if line.startswith('version='):
+                return line.split('=', 1)[1].strip()
+    return None
+
+
+def run_scenario(name, uri, out_dir, workers, quick, overviews):
+    '''Export one scenario in this process and return its measurements'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from qgis.core import Qgis, QgsApplication, QgsRectangle, QgsCoordinateReferenceSystem
+    app = QgsApplication([], False)
+    app.initQgis()
+    sys.path.insert(0, PLUGIN_DIR)
+    import basemap_2_geopackage as bm
+    scenario = SCENARIOS[name]
+    size = scenario['size']/4 if quick else scenario['size']
+    extent = QgsRectangle(ORIGIN[0], ORIGIN[1], ORIGIN[0]+size, ORIGIN[1]+size)
+    output = os.path.join(out_dir, '{}.gpkg'.format(name))
+    # no disk cache, every run has to go to the server
+    options = bm.exportOptions(workers=workers, cache=False, offline=False, output_mode='tables')
+    t0 = time.time()
+    ok = bm.export_basemap(uri, extent, scenario['rows'], scenario['cols'], scenario['pixel_sizes'],
+                            QgsCoordinateReferenceSystem(scenario['target']), output,
+                            build_overviews=overviews, options=options)
+    elapsed = time.time()-t0
+    with open(bm.stats_path(output)) as f:
+        stats = json.load(f)
+    tiles, tile_bytes, overview_tiles = count_tiles(output)
+    result = {'ok': bool(ok),
+            'qgis': Qgis.QGIS_VERSION,
+            'elapsed_s': round(elapsed, 3),
+            'tiles': tiles,
+            'overview_tiles': overview_tiles,
+            # base level only, so runs with and without --overviews compare
+            'tiles_per_s': round(tiles/elapsed, 2) if elapsed else 0,
+            'mb_per_s': round(tile_bytes/MB/elapsed, 3) if elapsed else 0,
+            'pixels_per_s': round(stats['pixels']/elapsed, 1) if elapsed else 0,
+            'peak_rss_mb': peak_rss_mb(),
+            'output_mb': round(os.path.getsize(output)/MB, 3),
+            'retries': stats['retries'],
+            'failed_cells': len(stats.get('failed', [])),
+            'bottleneck': stats['bottleneck']}
+    app.exitQgis()
+    return result
+
+
+def run_child(name, uri, out_dir, args):
+    '''Run a scenario in a fresh process. Returns its measurements, or an
+    error entry if it crashed'''
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', name, '--uri', uri,
+            '--out-dir', out_dir, '--workers', str(args.workers)]
+    if args.quick:
+        cmd.append('--quick')
+    if args.overviews:
+        cmd.append('--overviews')
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        return {'ok': False, 'error': proc.stderr.strip()[-2000:]}
+    return json.loads(lines[-1])
+
+
+def compare(results, baseline, max_regression):
+    '''Print each scenario against the baseline run. Returns the names of
+    scenarios whose tiles/s dropped by more than max_regression percent'''
+    regressed = []
+    print('\n{:<14}{:>12}{:>12}{:>10}'.format('scenario', 'tiles/s', 'baseline', 'change'))
+    for name, res in results['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if not res.get('ok') or not old or not old.get('ok') or not old.get('tiles_per_s'):
+            print('{:<14}{:>12}{:>12}{:>10}'.format(name, res.get('tiles_per_s', '-'), '-', '-'))
+            continue
+        change = (res['tiles_per_s']-old['tiles_per_s'])/old['tiles_per_s']*100
+        print('{:<14}{:>12}{:>12}{:>9.1f}%'.format(name, res['tiles_per_s'], old['tiles_per_s'], change))
+        if change < -max_regression:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark basemap exports against a local mock server')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run: {}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--quick', action='store_true', help='quarter size extents')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--overviews', action='store_true', help='build overviews as part of each export')
+    parser.add_argument('--latency', type=float, default=0.0, help='mock server seconds per response')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='mock server MB/s per response, 0 for no limit')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with 503')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--max-regression', type=float, default=10.0, help='allowed tiles/s drop in percent')
+    parser.add_argument('--results-dir', default=os.path.join(HERE, 'results'))
+    # used when a scenario runs in its own process
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--uri', help=argparse.SUPPRESS)
+    parser.add_argument('--out-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.uri, args.out_dir, args.workers, args.quick, args.overviews)))
+        return 0
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(unknown)))
+    server = mockServer(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate).start()
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'plugin_version': plugin_version(),
+                'settings': {'quick': args.quick, 'workers': args.workers, 'overviews': args.overviews,
+                            'latency': args.latency, 'bandwidth': args.bandwidth, 'error_rate': args.error_rate},
+                'scenarios': collections.OrderedDict()}
+    try:
+        with tempfile.TemporaryDirectory() as out_dir:
+            for name in names:
+                uri = server.wms_uri() if SCENARIOS[name]['source'] == 'wms' else server.xyz_uri()
+                before = server.counters()
+                res = run_child(name, uri, out_dir, args)
+                after = server.counters()
+                res['server_requests'] = after['requests']-before['requests']
+                res['server_errors'] = after['errors']-before['errors']
+                res['server_mb'] = round((after['bytes_sent']-before['bytes_sent'])/MB, 3)
+                results['scenarios'][name] = res
+                if res.get('ok'):
+                    print('{:<14} {:>8} tiles {:>9} tiles/s {:>8} MB/s  peak {} MB  output {} MB'.format(
+                        name, res['tiles'], res['tiles_per_s'], res['mb_per_s'], res['peak_rss_mb'], res['output_mb']))
+                else:
+                    print('{:<14} failed\n{}'.format(name, res.get('error', '')))
+    finally:
+        server.stop()
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, '{}.json'.format(time.strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nResults saved to {}'.format(path))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.max_regression)
+        if regressed:
+            print('\nThroughput regressed by more than {}%: {}'.format(args.max_regression, ', '.join(regressed)))
+            return 1
+    return 0 if all(r.get('ok') for r in results['scenarios'].values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())